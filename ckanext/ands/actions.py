@@ -0,0 +1,185 @@
+from datetime import datetime
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.helpers import date_str_to_datetime
+
+from ckanext.ands.model import DoiRequest, list_doi_requests, package_id_for_doi
+
+MARKER_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+doi_request_fields = (
+    'paper_title',
+    'conference_or_journal_title',
+    'author_list',
+    'doi_title',
+    'doi_description',
+    'message_to_admin_optional',
+)
+
+
+def doi_mint_batch(context, data_dict):
+    '''Mint ANDS DOIs for a list of datasets.
+
+    Requests to ANDS are made concurrently, datasets which are private or
+    already have a DOI are skipped.
+
+    :param ids: the ids or names of the datasets
+    :type ids: list of strings
+    :param workers: maximum number of concurrent requests to ANDS (optional,
+        defaults to ``ckanext.ands.batch_workers``)
+    :type workers: int
+
+    :returns: one result per dataset, in the order given, each with ``id``,
+        ``success``, ``doi`` and ``message`` keys
+    :rtype: list of dictionaries
+    '''
+    toolkit.check_access('doi_mint_batch', context, data_dict)
+
+    ids = data_dict.get('ids')
+    if isinstance(ids, basestring):
+        ids = [id.strip() for id in ids.split(',') if id.strip()]
+    if not ids:
+        raise toolkit.ValidationError({'ids': ['Missing value']})
+
+    workers = data_dict.get('workers')
+    if workers is not None:
+        try:
+            workers = int(workers)
+        except ValueError:
+            raise toolkit.ValidationError({'workers': ['Invalid integer']})
+        if workers < 1:
+            raise toolkit.ValidationError({'workers': ['Must be at least 1']})
+
+    # Pulls in the controller and HTTP client, only load them when used
+    from ckanext.ands.batch import mint_dois
+
+    return mint_dois(context, ids, workers=workers)
+
+
+@toolkit.side_effect_free
+def package_show_by_doi(context, data_dict):
+    '''Return the metadata of the dataset with the given DOI.
+
+    :param doi: the DOI of the dataset, e.g. ``10.5072/abc123``
+    :type doi: string
+
+    :rtype: dictionary
+    '''
+    toolkit.check_access('package_show_by_doi', context, data_dict)
+
+    doi = toolkit.get_or_bust(data_dict, 'doi')
+    package_id = package_id_for_doi(doi)
+    if package_id is None:
+        raise toolkit.ObjectNotFound('No dataset has DOI {}'.format(doi))
+
+    return toolkit.get_action('package_show')(context, {'id': package_id})
+
+
+def doi_request_list_schema():
+    ignore_missing = toolkit.get_validator('ignore_missing')
+    natural_number_validator = toolkit.get_validator('natural_number_validator')
+    return {
+        'limit': [ignore_missing, natural_number_validator],
+    }
+
+
+def _parse_date(data_dict, key, errors):
+    value = data_dict.get(key)
+    if not value:
+        return None
+    try:
+        return date_str_to_datetime(value)
+    except (TypeError, ValueError):
+        errors[key] = ['Invalid date, expected YYYY-MM-DD']
+
+
+def _parse_marker(marker, errors):
+    if not marker:
+        return None
+    try:
+        created, id = marker.split(',')
+        return datetime.strptime(created, MARKER_FORMAT), int(id)
+    except ValueError:
+        errors['marker'] = ['Invalid marker']
+
+
+@toolkit.side_effect_free
+def doi_request_list(context, data_dict):
+    '''List DOI requests, newest first.
+
+    :param status: only requests with this status, ``pending`` or
+        ``approved`` (optional)
+    :type status: string
+    :param owner_org: only requests for datasets in this organization, id or
+        name (optional)
+    :type owner_org: string
+    :param created_after: only requests made on or after this date (optional)
+    :type created_after: ISO date string
+    :param created_before: only requests made before this date (optional)
+    :type created_before: ISO date string
+    :param marker: ``next_marker`` from the previous page, to get the next one
+        (optional)
+    :type marker: string
+    :param limit: maximum number of requests to return (optional, default
+        50, at most 1000, 0 returns none)
+    :type limit: int
+
+    :returns: ``results``, the requests, and ``next_marker``, which is None
+        on the last page
+    :rtype: dictionary
+    '''
+    toolkit.check_access('doi_request_list', context, data_dict)
+
+    data, errors = toolkit.navl_validate(data_dict, doi_request_list_schema(), context)
+
+    status = data_dict.get('status')
+    if status and status not in (DoiRequest.PENDING, DoiRequest.APPROVED):
+        errors['status'] = ['Must be pending or approved']
+
+    owner_org = data_dict.get('owner_org')
+    if owner_org:
+        org = model.Group.get(owner_org)
+        if org is None:
+            errors['owner_org'] = ['Organization not found']
+        else:
+            owner_org = org.id
+
+    created_after = _parse_date(data_dict, 'created_after', errors)
+    created_before = _parse_date(data_dict, 'created_before', errors)
+    marker = _parse_marker(data_dict.get('marker'), errors)
+
+    limit = min(data.get('limit', 50), 1000)
+
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    rows = list_doi_requests(status=status, owner_org=owner_org, created_after=created_after,
+                             created_before=created_before, marker=marker, limit=limit)
+
+    results = []
+    for doi_request, package, user in rows:
+        result = {
+            'id': doi_request.id,
+            'status': doi_request.status,
+            'created': doi_request.created.isoformat(),
+            'updated': doi_request.updated and doi_request.updated.isoformat(),
+            'resolved': doi_request.resolved and doi_request.resolved.isoformat(),
+            'doi': doi_request.doi,
+            'package_id': package.id,
+            'package_name': package.name,
+            'package_title': package.title,
+            'owner_org': package.owner_org,
+            'user_id': user.id,
+            'user_name': user.name,
+        }
+        for field in doi_request_fields:
+            result[field] = getattr(doi_request, field)
+        results.append(result)
+
+    next_marker = None
+    if rows and len(rows) == limit:
+        last = rows[-1][0]
+        next_marker = '{},{}'.format(last.created.strftime(MARKER_FORMAT), last.id)
+
+    return {'results': results, 'next_marker': next_marker}
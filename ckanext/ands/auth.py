@@ -1,13 +1,28 @@
 import ckan.plugins.toolkit as toolkit
 from ckan.logic.auth.delete import package_delete as default_package_delete
 
+from ckanext.ands.helpers import package_has_doi
+
 
 def package_delete(context, data_dict=None):
     if not context['auth_user_obj'].sysadmin:
 
-        package = toolkit.get_action('package_show')(None, data_dict)
-
-        if package.get('doi_id'):
+        if package_has_doi(data_dict['id']):
             return {'success': False, 'msg': 'This dataset has a DOI so cannot be deleted'}
 
     return default_package_delete(context, data_dict=data_dict)
+
+
+def doi_mint_batch(context, data_dict=None):
+    # Sysadmins only, they skip auth checks entirely
+    return {'success': False, 'msg': 'Only sysadmins can mint DOIs'}
+
+
+def doi_request_list(context, data_dict=None):
+    return {'success': False, 'msg': 'Only sysadmins can list DOI requests'}
+
+
+@toolkit.auth_allow_anonymous_access
+def package_show_by_doi(context, data_dict=None):
+    # package_show does the real check once the dataset is found
+    return {'success': True}
@@ -0,0 +1,144 @@
+"""
+Mint DOIs for many datasets at once.
+
+Datasets are looked up and their XML built in the calling thread, only the
+round trip to ANDS is handed to the worker pool. Results are applied back in
+the calling thread so package_update always runs on the caller's DB session.
+Each is saved holding the dataset's mint lock, and dropped if an approval from
+the dataset page saved a DOI while it was being minted.
+"""
+import logging
+from multiprocessing.pool import ThreadPool
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from pylons import config
+
+from ckanext.ands.controller import (
+    MintError, build_xml, error_text, get_xml_url, log_attempt, request_mint, save_doi)
+from ckanext.ands.model import MintAttempt, lock_package_for_mint, package_doi
+
+log = logging.getLogger(__name__)
+
+
+def get_batch_workers():
+    return int(config.get('ckanext.ands.batch_workers', 4))
+
+
+def dataset_url_for(dataset):
+    # Built from site_url rather than url_for so it also works from paster commands
+    return '{}/dataset/{}'.format(config['ckan.site_url'].rstrip('/'), dataset['name'])
+
+
+def _context(context):
+    # Actions write to their context, so give each call its own
+    return {'model': model, 'session': model.Session, 'user': context.get('user')}
+
+
+def _result(id, success, message, doi=None):
+    return {'id': id, 'success': success, 'doi': doi, 'message': message}
+
+
+def _post(job):
+    dataset, dataset_url, xml = job
+    try:
+        return request_mint(get_xml_url(dataset_url), xml), None
+    except Exception as exp:
+        return None, exp
+
+
+def _prepare(context, id):
+    """
+    Look up a dataset and build the XML to send for it
+    @return: (dataset, dataset_url, xml) or a failed result dict
+    """
+    try:
+        dataset = toolkit.get_action('package_show')(_context(context), {'id': id})
+    except toolkit.ObjectNotFound:
+        return _result(id, False, 'Dataset not found')
+
+    if dataset['private']:
+        return _result(id, False, 'Cannot add a DOI to a private dataset')
+    if dataset.get('doi_id'):
+        return _result(id, False, 'Dataset already has a DOI', doi=dataset['doi_id'])
+
+    try:
+        xml = build_xml(dataset)
+    except KeyError as exp:
+        return _result(id, False, 'Could not build XML, missing {}'.format(exp))
+
+    return dataset, dataset_url_for(dataset), xml
+
+
+def _apply(context, id, dataset, dataset_url, result, error):
+    # A minted DOI is logged straight away, so it's kept even if saving it fails
+    log_attempt(dataset['id'], MintAttempt.MINT, result, error, separately=result is not None and result.minted)
+    if isinstance(error, MintError):
+        return _result(id, False, error_text(error))
+    if error is not None:
+        return _result(id, False, u'Error contacting DOI server: {}'.format(error_text(error)))
+
+    if not result.minted:
+        return _result(id, False, result.error_message())
+
+    doi = result.doi
+    # Held until save_doi commits, see dataset_doi_admin_process
+    lock_package_for_mint(dataset['id'])
+    existing = package_doi(dataset['id'])
+    if existing:
+        model.Session.commit()
+        log.warning('DOI %s minted for %s is unused, the dataset was given %s meanwhile', doi, id, existing)
+        return _result(id, False, 'Dataset was given a DOI while this one was minted', doi=existing)
+
+    try:
+        save_doi(_context(context), dataset, doi, dataset_url)
+    except toolkit.ValidationError as exp:
+        log.error('DOI %s minted for %s but the dataset could not be updated: %s', doi, id, exp.error_dict)
+        model.Session.rollback()
+        return _result(id, False, 'DOI minted but dataset update failed: {}'.format(exp.error_dict), doi=doi)
+    except Exception as exp:
+        # Not left to stop the batch, the other datasets' DOIs are minted too
+        log.exception('DOI %s minted for %s but the dataset could not be updated', doi, id)
+        model.Session.rollback()
+        return _result(id, False, u'DOI minted but dataset update failed: {}'.format(error_text(exp)), doi=doi)
+
+    return _result(id, True, 'DOI Created successfully', doi=doi)
+
+
+def mint_dois(context, ids, workers=None):
+    """
+    Mint a DOI for each of the given datasets
+    @param context: action context, the user must be allowed to set doi_id
+    @param ids: list of dataset ids or names
+    @param workers: maximum number of concurrent requests to ANDS
+    @return: list of result dicts (id, success, doi, message), in the order given
+    """
+    if workers is None:
+        workers = get_batch_workers()
+
+    results = [None] * len(ids)
+    jobs = []
+    for index, id in enumerate(ids):
+        prepared = _prepare(context, id)
+        if isinstance(prepared, dict):
+            results[index] = prepared
+        else:
+            jobs.append((index, prepared))
+
+    if not jobs:
+        return results
+
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        responses = pool.imap(_post, [job for index, job in jobs])
+        for (index, (dataset, dataset_url, xml)), (result, error) in zip(jobs, responses):
+            results[index] = _apply(context, ids[index], dataset, dataset_url, result, error)
+            # Each dataset's attempt is kept whatever happens to the next
+            model.Session.commit()
+            log.info('DOI mint for %s: %s', ids[index], results[index]['message'])
+    finally:
+        model.Session.commit()
+        pool.close()
+        pool.join()
+
+    return results
@@ -0,0 +1,268 @@
+"""
+Shared HTTP client for the ANDS DOI service.
+
+One connection-pooled session is kept per process so repeated calls reuse
+kept-alive connections instead of paying for a new TCP and TLS handshake each
+time. Only failures to connect are retried, a mint request that reached ANDS
+must never be sent twice.
+
+Calls can be limited to a rate shared by every process (ckanext.ands.rate_limit),
+and a circuit breaker in each process stops calling ANDS for a while once most
+recent calls have failed, so an outage fails fast instead of every request
+waiting out the timeout.
+
+Metrics recorded:
+    ands.connect            seconds spent opening a connection (incl. TLS)
+    ands.request            seconds for the whole request
+    ands.connections.new    connections opened
+    ands.requests           requests made
+    ands.errors             requests that raised
+    ands.rate_limit.wait    seconds spent waiting for the rate limit
+    ands.rate_limited       requests given up on waiting for the rate limit
+    ands.breaker.open       times the circuit breaker opened
+    ands.breaker.rejected   requests refused while it was open
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from pylons import config
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from ckanext.ands import metrics
+from ckanext.ands.model import take_rate_limit_token
+
+log = logging.getLogger(__name__)
+
+_session = None
+_session_pid = None
+_breaker = None
+_lock = threading.Lock()
+
+
+class RateLimited(requests.ConnectionError):
+    pass
+
+
+class CircuitOpen(requests.ConnectionError):
+    def __init__(self, retry_after):
+        super(CircuitOpen, self).__init__(
+            'ANDS has been failing, not contacting it for {:.0f} seconds'.format(retry_after))
+        self.retry_after = retry_after
+
+
+def get_timeout():
+    return (float(config.get('ckanext.ands.connect_timeout', 5)),
+            float(config.get('ckanext.ands.read_timeout', 30)))
+
+
+class CircuitBreaker(object):
+    """
+    Refuses calls for cooldown seconds once at least threshold of the last
+    window calls failed. After that one trial call is let through, calls carry
+    on as normal if it succeeds, otherwise the breaker opens again.
+    """
+    def __init__(self, threshold=0.5, window=20, min_calls=5, cooldown=60):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.outcomes.clear()
+            self.opened = None
+            self.trial = False
+
+    def retry_after(self):
+        """
+        @return: seconds until calls will be let through, 0 if they are now
+        """
+        with self._lock:
+            if self.opened is None:
+                return 0
+            return max(0, self.opened + self.cooldown - time.time())
+
+    def before_call(self):
+        """
+        @raise CircuitOpen: if the call shouldn't be made
+        """
+        with self._lock:
+            if self.opened is None:
+                return
+            retry_after = self.opened + self.cooldown - time.time()
+            if retry_after > 0 or self.trial:
+                metrics.incr('ands.breaker.rejected')
+                raise CircuitOpen(max(0, retry_after))
+            # This caller is the trial, anyone else waits for how it goes
+            self.trial = True
+
+    def release(self):
+        """
+        For a call let through that was given up on before reaching ANDS,
+        so a trial call doesn't close or reopen the breaker
+        """
+        with self._lock:
+            self.trial = False
+
+    def record(self, success):
+        with self._lock:
+            if self.opened is not None:
+                self.trial = False
+                if success:
+                    log.info('ANDS is responding again, closing the circuit breaker')
+                    self.opened = None
+                    self.outcomes.clear()
+                else:
+                    self.opened = time.time()
+                return
+
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures >= self.threshold * len(self.outcomes):
+                log.warning('%s of the last %s calls to ANDS failed, not calling it for %ss',
+                            failures, len(self.outcomes), self.cooldown)
+                metrics.incr('ands.breaker.open')
+                self.opened = time.time()
+
+
+def get_breaker():
+    global _breaker
+    if _breaker is None:
+        with _lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    threshold=float(config.get('ckanext.ands.breaker_threshold', 0.5)),
+                    window=int(config.get('ckanext.ands.breaker_window', 20)),
+                    min_calls=int(config.get('ckanext.ands.breaker_min_calls', 5)),
+                    cooldown=float(config.get('ckanext.ands.breaker_cooldown', 60)),
+                )
+    return _breaker
+
+
+def wait_for_rate_limit():
+    """
+    Block until a call to ANDS is allowed by ckanext.ands.rate_limit
+    @raise RateLimited: if none is within ckanext.ands.rate_limit_wait seconds
+    """
+    rate = float(config.get('ckanext.ands.rate_limit', 0))
+    if rate <= 0:
+        return
+    burst = float(config.get('ckanext.ands.rate_limit_burst', 0)) or max(1.0, rate)
+    start = time.time()
+    deadline = start + float(config.get('ckanext.ands.rate_limit_wait', 10))
+    while not take_rate_limit_token(rate, burst):
+        if time.time() >= deadline:
+            metrics.incr('ands.rate_limited')
+            raise RateLimited('Too many requests to ANDS at the moment')
+        time.sleep(min(1.0 / rate, max(0, deadline - time.time())))
+    metrics.timing('ands.rate_limit.wait', time.time() - start)
+
+
+def _is_server_error(resp):
+    return isinstance(resp.status_code, int) and resp.status_code >= 500
+
+
+def _timed_connection_class(cls):
+    def connect(self):
+        start = time.time()
+        try:
+            return cls.connect(self)
+        finally:
+            metrics.incr('ands.connections.new')
+            metrics.timing('ands.connect', time.time() - start)
+
+    return type('Timed' + cls.__name__, (cls,), {'connect': connect})
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Records how long new connections take to open
+    """
+    def get_connection(self, url, proxies=None):
+        pool = super(TimedHTTPAdapter, self).get_connection(url, proxies)
+        if not getattr(pool.ConnectionCls, '_ands_timed', False):
+            pool.ConnectionCls = _timed_connection_class(pool.ConnectionCls)
+            pool.ConnectionCls._ands_timed = True
+        return pool
+
+
+def _build_session():
+    retries = Retry(
+        total=int(config.get('ckanext.ands.connect_retries', 2)),
+        read=0,
+        backoff_factor=float(config.get('ckanext.ands.retry_backoff', 0.5)),
+    )
+    adapter = TimedHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=int(config.get('ckanext.ands.pool_size', 10)),
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Return this process's session, built on first use so forked workers
+    don't share sockets with their parent
+    """
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def close():
+    """
+    Drop pooled connections, the next request starts a fresh session
+    """
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def post(url, **kwargs):
+    """
+    @raise CircuitOpen: without calling ANDS, if it has been failing
+    @raise RateLimited: if the rate limit didn't allow a call in time
+    """
+    breaker = get_breaker()
+    breaker.before_call()
+    try:
+        wait_for_rate_limit()
+    except Exception:
+        # Says nothing about ANDS, recorded as neither success nor failure
+        breaker.release()
+        raise
+
+    success = False
+    try:
+        kwargs.setdefault('timeout', get_timeout())
+        metrics.incr('ands.requests')
+        start = time.time()
+        try:
+            resp = get_session().post(url, **kwargs)
+        except requests.RequestException:
+            metrics.incr('ands.errors')
+            raise
+        finally:
+            metrics.timing('ands.request', time.time() - start)
+        success = not _is_server_error(resp)
+        return resp
+    finally:
+        breaker.record(success)
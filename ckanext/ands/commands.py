@@ -0,0 +1,151 @@
+import sys
+
+import ckan.plugins.toolkit as toolkit
+from ckan.lib.cli import CkanCommand
+
+
+class AndsCommand(CkanCommand):
+    '''Manage ANDS DOIs
+
+    Usage:
+        ands mint [-w WORKERS] <id> [<id> ...]
+            Mint DOIs for the given datasets, use - to read ids from stdin,
+            one per line
+
+        ands worker [--once]
+            Mint DOIs queued from the approve page when
+            ckanext.ands.async_mint is enabled, --once stops when the queue
+            is empty
+
+        ands mail-worker [--once]
+            Send emails queued when ckanext.ands.async_mail is enabled
+
+        ands initdb
+            Create the extension's tables, or bring them up to date
+
+        ands export [-o FILE]
+            Write DataCite XML for every public dataset to FILE, or stdout
+
+        ands resync [--force] [-w WORKERS]
+            Send ANDS the metadata of every dataset with a DOI that has changed
+            since it was last sent, --force sends all of them
+
+        ands fake-ands [--port PORT] [--latency SECONDS] [--failure-rate RATE]
+            Serve a stand-in for the ANDS mint service, for load testing
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = None
+    min_args = 1
+
+    def __init__(self, name):
+        super(AndsCommand, self).__init__(name)
+        self.parser.add_option('-w', '--workers', dest='workers', type='int', default=None,
+                               help='Maximum number of concurrent requests to ANDS')
+        self.parser.add_option('--once', dest='once', action='store_true', default=False,
+                               help='Stop when there are no more queued jobs')
+        self.parser.add_option('-o', '--output', dest='output', default=None,
+                               help='File to write to, defaults to stdout')
+        self.parser.add_option('--force', dest='force', action='store_true', default=False,
+                               help='Resync datasets even if they are unchanged')
+        self.parser.add_option('--port', dest='port', type='int', default=8765,
+                               help='Port for fake-ands to listen on')
+        self.parser.add_option('--latency', dest='latency', type='float', default=0.0,
+                               help='Seconds fake-ands delays each response by')
+        self.parser.add_option('--failure-rate', dest='failure_rate', type='float', default=0.0,
+                               help='Fraction of requests fake-ands fails')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'mint':
+            self.mint(self.args[1:])
+        elif cmd == 'worker':
+            self.worker()
+        elif cmd == 'mail-worker':
+            self.mail_worker()
+        elif cmd == 'initdb':
+            self.initdb()
+        elif cmd == 'export':
+            self.export()
+        elif cmd == 'resync':
+            self.resync()
+        elif cmd == 'fake-ands':
+            self.fake_ands()
+        else:
+            print('Command {} not recognized'.format(cmd))
+            sys.exit(1)
+
+    def _site_user_context(self):
+        site_user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+        return {'user': site_user['name']}
+
+    def mint(self, ids):
+        if ids == ['-']:
+            ids = [line.strip() for line in sys.stdin if line.strip()]
+        if not ids:
+            print('No datasets given')
+            sys.exit(1)
+
+        results = toolkit.get_action('doi_mint_batch')(
+            self._site_user_context(), {'ids': ids, 'workers': self.options.workers})
+
+        failed = 0
+        for result in results:
+            if result['success']:
+                print('{id}: {doi}'.format(**result))
+            else:
+                failed += 1
+                print(u'{id}: FAILED {message}'.format(**result).encode('utf-8'))
+
+        print('{} minted, {} failed'.format(len(results) - failed, failed))
+        if failed:
+            sys.exit(1)
+
+    def worker(self):
+        from ckanext.ands.jobs import work
+
+        work(self._site_user_context(), once=self.options.once)
+
+    def mail_worker(self):
+        from ckanext.ands.mail import work
+
+        work(once=self.options.once)
+
+    def initdb(self):
+        from ckanext.ands import migration
+
+        print('Database at version {}'.format(migration.upgrade()))
+
+    def export(self):
+        from ckanext.ands.datacite import get_serializer
+        from ckanext.ands.model import iter_public_datasets
+
+        if self.options.output:
+            with open(self.options.output, 'wb') as f:
+                count = get_serializer().write(f, iter_public_datasets())
+            print('Exported {} datasets to {}'.format(count, self.options.output))
+        else:
+            get_serializer().write(sys.stdout, iter_public_datasets())
+
+    def resync(self):
+        from ckanext.ands.sync import FAILED, UNCHANGED, resync
+
+        counts = {}
+        for result in resync(force=self.options.force, workers=self.options.workers):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] != UNCHANGED:
+                print(u'{id} {doi}: {status} {message}'.format(**result).encode('utf-8'))
+
+        print(', '.join('{} {}'.format(count, status) for status, count in sorted(counts.items())) or
+              'No datasets have DOIs')
+        if counts.get(FAILED):
+            sys.exit(1)
+
+    def fake_ands(self):
+        from ckanext.ands.fake_ands import FakeAndsApp, serve
+
+        print('Set ckanext.ands.service_url = http://localhost:{}/'.format(self.options.port))
+        serve(FakeAndsApp(latency=self.options.latency, failure_rate=self.options.failure_rate),
+              port=self.options.port)
@@ -1,3 +1,6 @@
+import logging
+import time
+import uuid
 from json import loads
 
 import ckan.lib.base as base
@@ -7,7 +10,6 @@ import ckan.lib.render
 import ckan.logic as logic
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
-import requests
 from ckan.common import _, c
 from ckan.controllers.package import PackageController
 from ckan.lib.mailer import mail_recipient
@@ -15,13 +17,20 @@ from ckan.logic import clean_dict
 from ckan.logic import parse_params
 from ckan.logic import tuplize_dict
 from ckan.model import Session
-from lxml import etree
-from lxml.builder import ElementMaker
 from pylons import config
 from pylons import request
+from pylons import response
+from sqlalchemy.orm import sessionmaker
 
-from ckanext.ands.model import DoiRequest
-from helpers import package_get_year
+from ckanext.ands import datacite, metrics
+from ckanext.ands.cache import LRUCache
+from ckanext.ands.mail import async_mail_enabled, queue_mail
+from ckanext.ands.model import (
+    MintAttempt, add_doi_request, approve_doi_requests, doi_request_exists, enqueue_mint_job, iter_public_datasets,
+    lock_package_for_mint, mint_attempt_table, minted_doi_for_key, package_doi, package_id_for_doi, requestor_contacts,
+    set_sent_xml)
+
+log = logging.getLogger(__name__)
 
 NotFound = logic.NotFound
 NotAuthorized = logic.NotAuthorized
@@ -42,75 +51,319 @@ doi_request_fields = [
 ]
 
 
+def doi_request_field_name(field):
+    # 'Message to Admin (Optional)' -> 'message_to_admin_optional', as in the form and doi_requests
+    return field.lower().replace(' ', '_').translate(None, '()')
+
+MINT_SUCCESS_CODE = "MT001"
+UPDATE_SUCCESS_CODE = "MT002"
+
+# Built XML by package id, with the metadata_modified it was built from
+_xml_cache = LRUCache()
+
+
 def build_xml(dataset):
-    author = dataset['author']
+    return datacite.get_serializer().serialize(dataset)
 
-    publisher = config['ckanext.ands.publisher']
-    # Dev prefix default
-    doi_prefix = config.get('ckanext.ands.doi_prefix', '10.5072/')
 
-    # TODO what should this be?
-    ands_client_id = config['ckanext.ands.client_id']
+def cached_build_xml(dataset):
+    """
+    build_xml, only rebuilt when the dataset has been modified since
+    """
+    modified = dataset.get('metadata_modified')
+    cached = _xml_cache.get(dataset['id'])
+    if cached is not None and cached[0] == modified:
+        return cached[1]
 
-    namespaces = {
-        'xsi': "http://www.w3.org/2001/XMLSchema-instance",
-        None: "http://datacite.org/schema/kernel-3",
-    }
+    xml = build_xml(dataset)
+    _xml_cache.set(dataset['id'], (modified, xml))
+    return xml
 
-    Root = ElementMaker(
-        nsmap=namespaces
-    )
-    E = ElementMaker()
 
-    xml = Root.resource(
-        E.identifier(doi_prefix + ands_client_id, identifierType="DOI"),
-        E.creators(E.creator(E.creatorName(author))),
-        E.titles(E.title(dataset['title'])),
-        E.publisher(publisher),
-        E.publicationYear("{}".format(package_get_year(dataset))),
-        E.language('en'),
-        E.resourceType('gDMCP Dataset', resourceTypeGeneral="Dataset"),
-        E.descriptions(E.description(dataset['notes'], descriptionType="Abstract")),
-    )
+def record_sent_xml(package_id, xml):
+    """
+    Keep the XML ANDS now has for a dataset's DOI, and its hash. Not committed.
+    """
+    if isinstance(xml, str):
+        xml = xml.decode('utf-8')
+    modified = model.Package.get(package_id).metadata_modified
+    set_sent_xml(package_id, xml, datacite.xml_hash(xml), modified)
+
+
+def get_service_url():
+    # Overridable to point at a stand-in, see ckanext.ands.fake_ands
+    return config.get('ckanext.ands.service_url', 'https://services.ands.org.au/doi/1.1/')
+
+
+def _post_to_ands(service_url, contents):
+    shared_secret = config['ckanext.ands.shared_secret']
 
-    xml.attrib[etree.QName(namespaces['xsi'],
-                           'schemaLocation')] = "http://datacite.org/schema/kernel-3 http://schema.datacite.org/meta/kernel-3/metadata.xsd"
+    # Imported here, requests is only needed once we talk to ANDS
+    from ckanext.ands import client
 
-    return etree.tostring(xml, pretty_print=True)
+    #  Send data
+    return client.post(service_url, data={'xml': contents, 'shared_secret': shared_secret})
 
 
 def post_doi_request(dataset_url, contents):
     app_id = config['ckanext.ands.DOI_API_KEY']
-    shared_secret = config['ckanext.ands.shared_secret']
 
     mint_service_url = (
-        'https://services.ands.org.au/doi/1.1/mint.json/?app_id={}&url={}&debug={}'.format(
-            app_id, dataset_url, config.get('ckanext.ands.debug', False)))
+        '{}mint.json/?app_id={}&url={}&debug={}'.format(
+            get_service_url(), app_id, dataset_url, config.get('ckanext.ands.debug', False)))
+
+    return _post_to_ands(mint_service_url, contents)
+
+
+def post_doi_update(doi, dataset_url, contents):
+    """
+    Replace the metadata, and url, ANDS holds for a DOI
+    @return: response in the same form as post_doi_request's
+    """
+    app_id = config['ckanext.ands.DOI_API_KEY']
+
+    update_service_url = (
+        '{}update.json/?app_id={}&doi={}&url={}&debug={}'.format(
+            get_service_url(), app_id, doi, dataset_url, config.get('ckanext.ands.debug', False)))
+
+    return _post_to_ands(update_service_url, contents)
+
+
+class MintError(Exception):
+    pass
 
-    #  Send data
-    return requests.post(mint_service_url, data={'xml': contents, 'shared_secret': shared_secret})
 
+class AndsUnavailable(MintError):
+    """
+    ANDS couldn't be reached, or wasn't tried because of the rate limit or
+    circuit breaker
+    """
+    pass
 
-def email_requestors(dataset_id):
-    requests = Session.query(DoiRequest).filter_by(package_id=dataset_id)
 
+def get_xml_url(dataset_url):
+    # If running on local machine, just resolve DOI to the dev server
+    if 'localhost' in dataset_url or '127.0.0.1' in dataset_url:
+        return config.get('ckanext.ands.debug_url')
+    return dataset_url
+
+
+class MintResult(object):
+    """
+    A response from ANDS's mint or update call, parsed once
+    """
+    __slots__ = ('responsecode', 'type', 'doi', 'url', 'message', 'verbosemessage', 'elapsed')
+
+    def __init__(self, responsecode, type=u'', doi=None, url=None, message=u'', verbosemessage=u'',
+                 elapsed=None):
+        self.responsecode = responsecode
+        self.type = type
+        self.doi = doi
+        self.url = url
+        self.message = message
+        self.verbosemessage = verbosemessage
+        # Seconds the round trip took
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return '<MintResult {} {}>'.format(self.responsecode, self.doi)
+
+    @classmethod
+    def from_response(cls, resp, elapsed=None):
+        """
+        @param resp: response returned by post_doi_request or post_doi_update
+        @raise MintError: if the response can't be understood
+        """
+        try:
+            json = loads(resp.content)
+        except ValueError as exp:
+            # Only the start, it could be a whole error page
+            raise MintError(u"Invalid response from DOI server: {} :: {}".format(
+                exp, resp.content[:200].decode('utf-8', 'replace')))
+        try:
+            response_dict = json["response"]
+        except (KeyError, TypeError):
+            raise MintError("Response had no response key: {}".format(json))
+
+        return cls(
+            response_dict.get("responsecode"),
+            type=response_dict.get("type", u''),
+            doi=response_dict.get("doi"),
+            url=response_dict.get("url"),
+            message=response_dict.get("message", u''),
+            verbosemessage=response_dict.get("verbosemessage", u''),
+            elapsed=elapsed,
+        )
+
+    @property
+    def minted(self):
+        return self.responsecode == MINT_SUCCESS_CODE
+
+    @property
+    def updated(self):
+        return self.responsecode == UPDATE_SUCCESS_CODE
+
+    def error_message(self):
+        return u'{} - {}. {}. {}'.format(self.responsecode, self.type, self.verbosemessage, self.message)
+
+
+def _request(post, *args):
+    import requests
+    from ckanext.ands.client import CircuitOpen, RateLimited
+
+    start = time.time()
+    try:
+        resp = post(*args)
+    except CircuitOpen as exp:
+        raise AndsUnavailable("ANDS isn't responding at the moment, try again in {:.0f} seconds".format(
+            exp.retry_after))
+    except RateLimited:
+        raise AndsUnavailable("Too many requests to ANDS at the moment, try again shortly")
+    except requests.RequestException as exp:
+        raise AndsUnavailable("Could not contact ANDS: {}".format(exp))
+    try:
+        result = MintResult.from_response(resp, time.time() - start)
+    except MintError:
+        metrics.incr('ands.mint.response.invalid')
+        raise
+
+    # A fixed name when ANDS leaves the code out, not ands.mint.response.None
+    metrics.incr('ands.mint.response.{}'.format(result.responsecode or 'unknown'))
+    log.info('ANDS response %s for %s: %s', result.responsecode, result.url, result.message)
+    return result
+
+
+def request_mint(dataset_url, contents):
+    """
+    Ask ANDS to mint a DOI
+    @return: MintResult
+    @raise AndsUnavailable: if ANDS couldn't be reached
+    @raise MintError: if the response can't be understood
+    """
+    return _request(post_doi_request, dataset_url, contents)
+
+
+def request_update(doi, dataset_url, contents):
+    """
+    Send ANDS new metadata for a DOI, returns and raises as request_mint
+    """
+    return _request(post_doi_update, doi, dataset_url, contents)
+
+
+def error_text(error):
+    """
+    An exception's message as unicode, whether it was given bytes or unicode
+    """
+    try:
+        return unicode(error)
+    except UnicodeError:
+        return str(error).decode('utf-8', 'replace')
+
+
+def log_attempt(package_id, operation, result=None, error=None, idempotency_key=None, separately=False):
+    """
+    Add a call to ANDS to the attempt log. Not committed.
+    @param operation: MintAttempt.MINT or MintAttempt.UPDATE
+    @param result: MintResult, if ANDS gave one
+    @param error: the exception raised instead
+    @param idempotency_key: from the approve form, see minted_doi_for_key
+    @param separately: commit it straight away in its own transaction instead
+    """
+    if result is not None:
+        success = result.minted if operation == MintAttempt.MINT else result.updated
+        values = dict(responsecode=result.responsecode, success=success, doi=result.doi,
+                      elapsed=result.elapsed, message=None if success else result.error_message())
+    else:
+        values = dict(success=False, message=error_text(error))
+    values.update(package_id=package_id, operation=operation, idempotency_key=idempotency_key)
+
+    if separately:
+        with model.meta.engine.begin() as connection:
+            connection.execute(mint_attempt_table.insert().values(**values))
+    else:
+        Session.add(MintAttempt(**values))
+
+
+@metrics.timed('ands.email_requestors')
+def email_requestors(dataset_id, dataset_url=None):
     subject = 'DataPortal DOI Request approved'
-    data = {
-        'dataset_url': toolkit.url_for(
+    if dataset_url is None:
+        dataset_url = toolkit.url_for(
             controller='package',
             action='read',
             id=dataset_id,
             qualified=True)
+    data = {
+        'dataset_url': dataset_url
     }
 
-    body = base.render(
-        'package/doi_request_completed.text',
-        extra_vars=data)
+    # Not base.render, it needs a request and this also runs from paster commands
+    body = base.render_jinja2('package/doi_request_completed.text', data)
+
+    queue = async_mail_enabled()
+    for name, email in requestor_contacts(dataset_id):
+        if queue:
+            # One each, requestors shouldn't see who else asked
+            queue_mail([(name, email)], subject, body)
+        else:
+            mail_recipient(name, email, subject, body)
+        metrics.incr('ands.email_requestors.recipients')
+    if queue:
+        Session.commit()
+
+
+def notify_requestors(dataset_id, dataset_url=None):
+    """
+    email_requestors, logging rather than raising if it fails. The DOI is
+    already saved by then, so it's not worth failing over.
+    @return: whether the requestors were emailed, or their emails queued
+    """
+    try:
+        email_requestors(dataset_id, dataset_url)
+    except Exception:
+        log.exception('Could not email the DOI requestors of %s', dataset_id)
+        Session.rollback()
+        metrics.incr('ands.email_requestors.failure')
+        return False
+    return True
+
+
+def save_doi(context, dataset, doi, dataset_url=None, xml=None, notify=True):
+    """
+    Store a freshly minted DOI against the dataset and let the requestors know
+    @param xml: the XML sent to ANDS, if not as build_xml would give
+    @param notify: email the requestors, otherwise left to the caller's notify_requestors
+    """
+    dataset['doi_id'] = doi
+    # ANDS has just been given this dataset's metadata, no need to send it again
+    context = dict(context or {}, ands_skip_sync=True)
+    with metrics.timer('ands.mint.save'):
+        toolkit.get_action('package_update')(context, dataset)
+
+        approve_doi_requests(dataset['id'], doi)
+        serializer = datacite.get_serializer()
+        if xml is None:
+            record_sent_xml(dataset['id'], serializer.serialize(dataset, doi))
+        else:
+            record_sent_xml(dataset['id'], serializer.with_identifier(xml, doi))
+        Session.commit()
 
-    for request in requests:
-        user = toolkit.get_action('user_show')(None, {'id': request.user_id})
-        if user['email']:
-            mail_recipient(user['display_name'], user['email'], subject, body)
+    if notify:
+        notify_requestors(dataset['id'], dataset_url)
+
+
+def stream_datacite_export():
+    """
+    DataCite XML for every public dataset, in chunks
+    Read through a session of its own, the response is streamed after the
+    request's Session has been removed.
+    """
+    session = sessionmaker(bind=model.meta.engine)()
+    try:
+        for chunk in datacite.get_serializer().stream(iter_public_datasets(session=session)):
+            yield chunk
+    finally:
+        session.close()
 
 
 class DatasetDoiController(PackageController):
@@ -125,6 +378,20 @@ class DatasetDoiController(PackageController):
         else:
             return self.doi_form(id)
 
+    def doi_redirect(self, doi):
+        package_id = package_id_for_doi(doi)
+        if package_id is None:
+            abort(404, _('DOI not found'))
+        return toolkit.redirect_to(controller='package', action='read', id=package_id)
+
+    def datacite_export(self):
+        if not c.userobj or not c.userobj.sysadmin:
+            abort(401, _('Unauthorized to export DataCite metadata'))
+
+        response.headers['Content-Type'] = 'application/xml; charset=utf-8'
+        response.headers['Content-Disposition'] = 'attachment; filename="datacite.xml"'
+        return stream_datacite_export()
+
     def dataset_doi_admin(self, id):
         dataset_url = toolkit.url_for(
             controller='package',
@@ -145,48 +412,69 @@ class DatasetDoiController(PackageController):
             return self.dataset_doi_admin_form(dataset_url, dataset)
 
     def dataset_doi_admin_form(self, dataset_url, dataset):
-        xml = build_xml(dataset)
+        with metrics.timer('ands.mint.build_xml'):
+            xml = cached_build_xml(dataset)
+        from ckanext.ands.client import get_breaker
+
         template = 'package/doi_admin.html'
-        return render(template, extra_vars={'xml': xml, 'dataset_url': dataset_url})
+        return render(template, extra_vars={'xml': xml, 'dataset_url': dataset_url,
+                                            'idempotency_key': uuid.uuid4().hex,
+                                            'ands_retry_after': int(get_breaker().retry_after())})
 
+    @metrics.timed('ands.mint.total')
     def dataset_doi_admin_process(self, dataset_url, dataset):
-        # If running on local machine, just resolve DOI to the dev server
-        if 'localhost' in dataset_url or '127.0.0.1' in dataset_url:
-            xml_url = config.get('ckanext.ands.debug_url')
-        else:
-            xml_url = dataset_url
-
         post_data = request.POST['xml']
 
-        resp = post_doi_request(xml_url, post_data)
-        try:
-            json = loads(resp.content)
-        except ValueError as exp:
-            h.flash_error("Invalid response from DOI server: {} :: {}".format(exp, resp.content))
+        if toolkit.asbool(config.get('ckanext.ands.async_mint', False)):
+            if enqueue_mint_job(dataset['id'], dataset_url, post_data, c.userobj.id):
+                h.flash_success("DOI request queued, it will be created shortly")
+            else:
+                h.flash_notice("This dataset already has a DOI, or one is already being created")
             return toolkit.redirect_to(dataset_url)
-        try:
-            response_dict = json["response"]
-        except KeyError:
-            h.flash_error("Response had no response key: {}".format(json))
+
+        # Concurrent approvals of the same dataset wait here for each other,
+        # then find the DOI the first one minted
+        lock_package_for_mint(dataset['id'])
+        doi = package_doi(dataset['id'])
+        if doi:
+            Session.commit()
+            h.flash_notice("This dataset already has a DOI: {}".format(doi))
             return toolkit.redirect_to(dataset_url)
 
-        doi = response_dict["doi"]
-        response_code = response_dict["responsecode"]
-        success_code = "MT001"
+        # Minted by an earlier submission of this form that didn't get as far as saving it
+        idempotency_key = request.POST.get('idempotency_key') or None
+        doi = minted_doi_for_key(dataset['id'], idempotency_key)
+        if doi:
+            save_doi(None, dataset, doi, xml=post_data)
+            h.flash_success("DOI Created successfully")
+            return toolkit.redirect_to(dataset_url)
 
-        if response_code == success_code:
-            dataset['doi_id'] = doi
-            toolkit.get_action('package_update')(None, dataset)
+        xml_url = get_xml_url(dataset_url)
 
-            email_requestors(dataset['id'])
+        try:
+            with metrics.timer('ands.mint.post'):
+                result = request_mint(xml_url, post_data)
+        except MintError as exp:
+            log_attempt(dataset['id'], MintAttempt.MINT, error=exp, idempotency_key=idempotency_key)
+            Session.commit()
+            metrics.incr('ands.mint.failure')
+            h.flash_error(error_text(exp))
+            return toolkit.redirect_to(dataset_url)
+
+        if result.minted:
+            # Kept even if saving it on the dataset fails, so a resubmission can use it.
+            # Committed separately, this transaction holds the lock until the DOI is saved.
+            log_attempt(dataset['id'], MintAttempt.MINT, result, idempotency_key=idempotency_key,
+                        separately=True)
+            save_doi(None, dataset, result.doi, xml=post_data)
 
+            metrics.incr('ands.mint.success')
             h.flash_success("DOI Created successfully")
         else:
-            type = response_dict["type"]
-            err_msg = response_dict["message"]
-            verbose_msg = response_dict["verbosemessage"]
-            msg = response_code + ' - ' + type + '. ' + verbose_msg + '. ' + err_msg
-            h.flash_error(_(msg))
+            log_attempt(dataset['id'], MintAttempt.MINT, result, idempotency_key=idempotency_key)
+            Session.commit()
+            metrics.incr('ands.mint.failure')
+            h.flash_error(_(result.error_message()))
 
         return toolkit.redirect_to(dataset_url)
 
@@ -204,6 +492,12 @@ class DatasetDoiController(PackageController):
             qualified=True
         )
 
+        # Before anything else, it saves loading the dataset at all
+        if c.userobj and doi_request_exists(id, c.userobj.id):
+            h.flash_notice("You've already requested a DOI for this dataset. "
+                            "You'll be emailed if it is approved.")
+            return toolkit.redirect_to(dataset_url)
+
         # check if package exists
         try:
             c.pkg_dict = get_action('package_show')(context, data_dict)
@@ -225,17 +519,7 @@ class DatasetDoiController(PackageController):
 
         ########################## ADD DOI STUFF ###########################
         template = 'package/doi.html'
-        fields = dict(
-            (field.lower().replace(' ', '_').translate(None, '()'), field)
-            for field in doi_request_fields
-        )
-
-        q = Session.query(DoiRequest).filter_by(package_id=c.pkg_dict['id'], user_id=c.userobj.id)
-        ((request_exists, ),) = Session.query(q.exists())
-        if request_exists:
-            h.flash_notice("You've already requested a DOI for this dataset. "
-                            "You'll be emailed if it is approved.")
-            return toolkit.redirect_to(dataset_url)
+        fields = dict((doi_request_field_name(field), field) for field in doi_request_fields)
 
         try:
             return render(template,
@@ -253,6 +537,7 @@ class DatasetDoiController(PackageController):
                 file=template))
             abort(404, msg)
 
+    @metrics.timed('ands.doi_request.total')
     def handle_submit(self, id):
         data = clean_dict(dict_fns.unflatten(tuplize_dict(parse_params(
             request.params))))
@@ -264,9 +549,29 @@ class DatasetDoiController(PackageController):
             qualified=True
         )
 
-        package = get_action('package_show')(None, {'id': id})
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user or c.author, 'auth_user_obj': c.userobj}
+        try:
+            package = get_action('package_show')(context, {'id': id})
+        except NotFound:
+            abort(404, _('Dataset not found'))
+        except NotAuthorized:
+            abort(401, _('Unauthorized to read package %s') % id)
         self.fail_if_private(package, data['dataset_url'])
 
+        # Only the form's fields, status and the like aren't for the requestor to set
+        values = dict((key, data.get(key)) for key in map(doi_request_field_name, doi_request_fields))
+        values.update(package_id=package['id'], user_id=c.userobj.id)
+
+        # Added first so a repeated or concurrent submit finds it and doesn't email again.
+        # Only committed once the email is sent or queued.
+        with metrics.timer('ands.doi_request.save'):
+            doi_request = add_doi_request(**values)
+        if doi_request is None:
+            h.flash_notice("You've already requested a DOI for this dataset. "
+                           "You'll be emailed if it is approved.")
+            return toolkit.redirect_to(data['dataset_url'])
+
         # Comma separated config var
         to_addrs = config['ckanext.ands.support_emails'].split(',')
 
@@ -274,17 +579,45 @@ class DatasetDoiController(PackageController):
 
         body = base.render(
             'package/doi_email.text',
-            extra_vars=data)
-
-        for email in to_addrs:
-            mail_recipient('Dataportal support', email, subject, body)
+            extra_vars=dict(values, dataset_url=data['dataset_url']))
 
-        data['package_id'] = package['id']
-        data['user_id'] = c.userobj.id
+        with metrics.timer('ands.doi_request.email'):
+            if async_mail_enabled():
+                # Sent once committed along with the request
+                queue_mail([('Dataportal support', email) for email in to_addrs], subject, body)
+            else:
+                for email in to_addrs:
+                    mail_recipient('Dataportal support', email, subject, body)
 
-        doi_request = DoiRequest(**data)
-        Session.add(doi_request)
         Session.commit()
 
         h.flash_success("DOI Request sent")
         return toolkit.redirect_to(data['dataset_url'])
+
+
+class DoiRequestAdminController(base.BaseController):
+    filter_keys = ('status', 'owner_org', 'created_after', 'created_before')
+
+    def index(self):
+        if not c.userobj or not c.userobj.sysadmin:
+            abort(401, _('Need to be system administrator to administer'))
+
+        filters = dict((key, request.params.get(key)) for key in self.filter_keys if request.params.get(key))
+        data_dict = dict(filters, marker=request.params.get('marker'))
+        try:
+            page = get_action('doi_request_list')(None, data_dict)
+        except ValidationError as exp:
+            h.flash_error(_('Invalid filter: {}').format(', '.join(exp.error_dict)))
+            page = get_action('doi_request_list')(None, {})
+            filters = {}
+
+        next_url = None
+        if page['next_marker']:
+            next_url = h.url_for(controller='ckanext.ands.controller:DoiRequestAdminController', action='index',
+                                 marker=page['next_marker'], **filters)
+
+        return render('admin/doi_requests.html', extra_vars={
+            'requests': page['results'],
+            'filters': filters,
+            'next_url': next_url,
+        })
@@ -0,0 +1,186 @@
+"""
+DataCite XML for datasets.
+
+The parts of a record that don't depend on the dataset are built once, each
+record is a copy of that skeleton with the dataset's fields filled in.
+lxml is only imported once XML is first needed, keeping plugin start up light.
+"""
+import hashlib
+import logging
+from copy import deepcopy
+
+from pylons import config as pylons_config
+
+from ckanext.ands.helpers import package_get_year
+
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+DATACITE_NAMESPACE = "http://datacite.org/schema/kernel-3"
+SCHEMA_LOCATION = "http://datacite.org/schema/kernel-3 http://schema.datacite.org/meta/kernel-3/metadata.xsd"
+
+log = logging.getLogger(__name__)
+
+# Dev prefix default
+DEFAULT_DOI_PREFIX = '10.5072/'
+
+
+def settings_from_config(config):
+    return {
+        'publisher': config['ckanext.ands.publisher'],
+        # TODO what should this be?
+        'client_id': config['ckanext.ands.client_id'],
+        'doi_prefix': config.get('ckanext.ands.doi_prefix', DEFAULT_DOI_PREFIX),
+    }
+
+
+class DataCiteSerializer(object):
+    def __init__(self, publisher, client_id, doi_prefix=DEFAULT_DOI_PREFIX):
+        from lxml import etree
+        from lxml.builder import ElementMaker
+        self.etree = etree
+
+        namespaces = {
+            'xsi': XSI_NAMESPACE,
+            None: DATACITE_NAMESPACE,
+        }
+
+        Root = ElementMaker(
+            nsmap=namespaces
+        )
+        E = ElementMaker()
+
+        self.skeleton = Root.resource(
+            E.identifier(doi_prefix + client_id, identifierType="DOI"),
+            E.creators(E.creator(E.creatorName())),
+            E.titles(E.title()),
+            E.publisher(publisher),
+            E.publicationYear(),
+            E.language('en'),
+            E.resourceType('gDMCP Dataset', resourceTypeGeneral="Dataset"),
+            E.descriptions(E.description(descriptionType="Abstract")),
+        )
+
+        self.skeleton.attrib[etree.QName(XSI_NAMESPACE, 'schemaLocation')] = SCHEMA_LOCATION
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**settings_from_config(config))
+
+    def build(self, dataset, doi=None):
+        """
+        @param dataset: package dict
+        @param doi: the dataset's DOI, once it has one
+        @return: lxml resource element for the dataset
+        """
+        xml = deepcopy(self.skeleton)
+        if doi:
+            xml[0].text = doi
+        xml[1][0][0].text = dataset['author']
+        xml[2][0].text = dataset['title']
+        xml[4].text = "{}".format(package_get_year(dataset))
+        xml[7][0].text = dataset['notes']
+        return xml
+
+    def serialize(self, dataset, doi=None):
+        return self.etree.tostring(self.build(dataset, doi), pretty_print=True)
+
+    def with_identifier(self, xml, doi):
+        """
+        XML as ANDS holds it once minted, with the identifier set to the DOI
+        @param xml: serialized resource, as posted to ANDS
+        @return: serialized XML, or xml as it was if it isn't a resource
+        """
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        try:
+            root = self.etree.fromstring(xml)
+        except (self.etree.XMLSyntaxError, ValueError):
+            return xml
+        identifier = root.find(self.etree.QName(DATACITE_NAMESPACE, 'identifier'))
+        if identifier is None:
+            return xml
+        identifier.text = doi
+        return self.etree.tostring(root, pretty_print=True)
+
+    def _write(self, fileobj, datasets):
+        """
+        Generator writing a resource per dataset to fileobj, yielding after each
+        Each is identified by the dataset's doi, where it has one. Datasets
+        with fields XML can't hold, such as control characters, are skipped.
+        """
+        with self.etree.xmlfile(fileobj, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('resources'):
+                for dataset in datasets:
+                    try:
+                        resource = self.build(dataset, dataset.get('doi'))
+                    except ValueError as exp:
+                        log.error('Left %s out of the DataCite export: %s', dataset.get('name'), exp)
+                        continue
+                    xf.write(resource)
+                    yield
+
+    def write(self, fileobj, datasets):
+        """
+        Write a resource for each dataset to fileobj as they're built, wrapped
+        in a resources element
+        @param fileobj: file-like object opened for binary writing
+        @param datasets: iterable of package dicts, with doi as iter_public_datasets gives
+        @return: number of resources written
+        """
+        return sum(1 for _ in self._write(fileobj, datasets))
+
+    def stream(self, datasets):
+        """
+        Same document as write, yielded in chunks as it's produced
+        @param datasets: iterable of package dicts
+        @return: generator of byte strings
+        """
+        buf = _ChunkBuffer()
+        for _ in self._write(buf, datasets):
+            if buf.chunks:
+                yield buf.pop()
+        yield buf.pop()
+
+
+class _ChunkBuffer(object):
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def xml_hash(xml):
+    """
+    @param xml: serialized XML
+    @return: hex digest identifying the XML, to tell whether it has changed
+    """
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return hashlib.sha1(xml).hexdigest()
+
+
+_settings = None
+_serializer = None
+
+
+def configure(config):
+    global _settings, _serializer
+    try:
+        _settings = settings_from_config(config)
+    except KeyError:
+        # Settings are only required once XML is needed
+        _settings = None
+    _serializer = None
+
+
+def get_serializer():
+    global _serializer
+    if _serializer is None:
+        _serializer = DataCiteSerializer(**(_settings or settings_from_config(pylons_config)))
+    return _serializer
@@ -0,0 +1,92 @@
+"""
+A stand-in for the ANDS DOI service, for load testing.
+
+Implements the mint.json call as post_doi_request uses it. Point CKAN at it
+with ckanext.ands.service_url and run it with ``paster ands fake-ands``.
+
+Responses:
+    MT001   DOI minted, a new DOI is made up for every request
+    MT006   the xml posted isn't well formed
+    MT009   app_id or shared_secret missing
+    MT005   failed at random, as often as failure_rate asks
+"""
+import json
+import random
+import threading
+import time
+import uuid
+
+from lxml import etree
+from webob import Request, Response
+
+MINT_PATH = '/mint.json/'
+
+
+class FakeAndsApp(object):
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, doi_prefix='10.5072/'):
+        """
+        @param latency: seconds every response is delayed by
+        @param jitter: up to this many more seconds added at random
+        @param failure_rate: fraction of requests answered with MT005
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.doi_prefix = doi_prefix
+        self.minted = 0
+        self._lock = threading.Lock()
+
+    def _response(self, responsecode, type, message, doi='', url='', app_id='', status=200):
+        body = {
+            'response': {
+                'type': type,
+                'responsecode': responsecode,
+                'message': message,
+                'verbosemessage': message,
+                'doi': doi,
+                'url': url,
+                'app_id': app_id,
+            }
+        }
+        return Response(json.dumps(body), status=status, content_type='application/json')
+
+    def mint(self, request):
+        app_id = request.GET.get('app_id', '')
+        url = request.GET.get('url', '')
+
+        if not app_id or not request.POST.get('shared_secret'):
+            return self._response('MT009', 'failure', 'You are not authorised to use this service',
+                                  url=url, app_id=app_id)
+
+        if random.random() < self.failure_rate:
+            return self._response('MT005', 'failure', 'The ANDS DOI service is currently unavailable',
+                                  url=url, app_id=app_id, status=500)
+
+        try:
+            etree.fromstring(request.POST.get('xml', '').encode('utf-8'))
+        except etree.XMLSyntaxError as exp:
+            return self._response('MT006', 'failure', 'Metadata failed validation: {}'.format(exp),
+                                  url=url, app_id=app_id)
+
+        with self._lock:
+            self.minted += 1
+        doi = '{}{}'.format(self.doi_prefix, uuid.uuid4().hex[:10])
+        return self._response('MT001', 'success', 'DOI {} was successfully minted.'.format(doi),
+                              doi=doi, url=url, app_id=app_id)
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.random() * self.jitter)
+
+        if request.path_info.rstrip('/') == MINT_PATH.rstrip('/') and request.method == 'POST':
+            response = self.mint(request)
+        else:
+            response = Response('Not found', status=404, content_type='text/plain')
+        return response(environ, start_response)
+
+
+def serve(app, host='127.0.0.1', port=8765):
+    from paste.httpserver import serve as paste_serve
+
+    paste_serve(app, host=host, port=port, use_threadpool=True, threadpool_workers=20)
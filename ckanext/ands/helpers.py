@@ -7,11 +7,31 @@ Copyright (c) 2013 'bens3'. All rights reserved.
 
 from pylons import config
 from datetime import datetime
-import dateutil.parser as parser
 
 from ckan.authz import has_user_permission_for_group_or_org
+from ckan.model import Session
 from ckan.plugins import toolkit
 
+from ckanext.ands.cache import LRUCache
+from ckanext.ands.model import DoiMintJob, groups_with_parents, package_doi, user_member_of
+
+# Rendered citations by package id, see package_citation
+_citation_cache = LRUCache()
+# Years by metadata_created timestamp, see package_get_year
+_year_cache = LRUCache()
+
+
+def configure(config):
+    _citation_cache.maxsize = int(config.get('ckanext.ands.citation_cache_size', 1000))
+
+
+def _parse_year(timestamp):
+    # CKAN gives ISO-8601, so the year is the first four characters
+    if timestamp[:4].isdigit() and timestamp[4:5] in ('', '-'):
+        return int(timestamp[:4])
+    import dateutil.parser as parser
+    return parser.parse(timestamp).year
+
 
 def package_get_year(pkg_dict):
     """
@@ -19,10 +39,15 @@ def package_get_year(pkg_dict):
     @param pkg_dict:
     @return:
     """
-    if not isinstance(pkg_dict['metadata_created'], datetime):
-        pkg_dict['metadata_created'] = parser.parse(pkg_dict['metadata_created'])
+    created = pkg_dict['metadata_created']
+    if isinstance(created, datetime):
+        return created.year
 
-    return pkg_dict['metadata_created'].year
+    year = _year_cache.get(created)
+    if year is None:
+        year = _parse_year(created)
+        _year_cache.set(created, year)
+    return year
 
 
 def get_site_title():
@@ -33,10 +58,62 @@ def get_site_title():
     return config.get("ckanext.doi.site_title")
 
 
+def package_citation(pkg_dict):
+    """
+    Helper function to return the rendered citation for a package
+    Only re-rendered when the package has been modified since it was cached.
+    @param pkg_dict:
+    @return: literal html
+    """
+    modified = pkg_dict.get('metadata_modified')
+    cached = _citation_cache.get(pkg_dict['id'])
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    citation = toolkit.literal(toolkit.render_snippet('snippets/package_citation_text.html',
+                                                      {'pkg_dict': pkg_dict}))
+    _citation_cache.set(pkg_dict['id'], (modified, citation))
+    return citation
+
+
+def invalidate_package_citation(package_id):
+    _citation_cache.pop(package_id)
+
+
 def now():
     return datetime.now()
 
 
+def request_cache(name):
+    """
+    A dict kept on the template context, so it only lasts for this request
+    Outside of a request a new, empty dict is returned each time.
+    @param name: attribute to keep it in
+    @return: dict
+    """
+    try:
+        cache = getattr(toolkit.c, name, None)
+    except TypeError:
+        # No request
+        return {}
+    if not isinstance(cache, dict):
+        cache = {}
+        setattr(toolkit.c, name, cache)
+    return cache
+
+
+def _org_read_cache():
+    return request_cache('_ands_org_read')
+
+
+def _can_read_org(userobj, org_id):
+    cache = _org_read_cache()
+    key = (userobj.id, org_id)
+    if key not in cache:
+        cache[key] = has_user_permission_for_group_or_org(org_id, userobj.name, 'read')
+    return cache[key]
+
+
 def can_request_doi(pkg):
     ''' Users can request a DOI if they are in the same org as the owner of the dataset '''
     userobj = toolkit.c.userobj
@@ -49,4 +126,53 @@ def can_request_doi(pkg):
         return True
     if owner_group_id is None:
         return False
-    return has_user_permission_for_group_or_org(owner_group_id, userobj.name, 'read')
+    return _can_read_org(userobj, owner_group_id)
+
+
+def can_request_doi_for_packages(pkgs):
+    ''' can_request_doi for a list of packages, checking org membership for all of them at once
+
+    Returns a dict of package id to whether the user can request a DOI for it.
+    '''
+    userobj = toolkit.c.userobj
+    if userobj and not userobj.sysadmin:
+        cache = _org_read_cache()
+        org_ids = set(pkg['owner_org'] for pkg in pkgs if pkg['owner_org']) - \
+            set(org_id for (user_id, org_id) in cache if user_id == userobj.id)
+
+        member_of = user_member_of(userobj.id, org_ids)
+        for org_id in member_of:
+            cache[(userobj.id, org_id)] = True
+
+        # Roles can cascade down the org hierarchy, leave those to the full check
+        for org_id in org_ids - member_of - groups_with_parents(org_ids - member_of):
+            cache[(userobj.id, org_id)] = False
+
+    return dict((pkg['id'], can_request_doi(pkg)) for pkg in pkgs)
+
+
+def package_has_doi(id_or_name):
+    """
+    Whether a dataset has a DOI, without loading the whole package
+    @param id_or_name: package id or name
+    @return: bool
+    """
+    cache = request_cache('_ands_package_doi')
+    if id_or_name not in cache:
+        cache[id_or_name] = bool(package_doi(id_or_name))
+    return cache[id_or_name]
+
+
+def invalidate_package_has_doi(pkg_dict):
+    cache = request_cache('_ands_package_doi')
+    cache.pop(pkg_dict.get('id'), None)
+    cache.pop(pkg_dict.get('name'), None)
+
+
+def doi_mint_pending(pkg):
+    ''' True if a DOI has been approved for the dataset but not yet minted '''
+    q = Session.query(DoiMintJob).filter(
+        DoiMintJob.package_id == pkg['id'],
+        DoiMintJob.status.in_([DoiMintJob.PENDING, DoiMintJob.RUNNING]))
+    ((pending, ),) = Session.query(q.exists())
+    return pending
@@ -0,0 +1,158 @@
+"""
+Background worker for queued DOI mints.
+
+Jobs are added by the approve page when ckanext.ands.async_mint is enabled
+and drained by ``paster ands worker``. Several workers can run at once, a job
+is only processed by the worker that claims it.
+"""
+import datetime
+import logging
+import time
+
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from pylons import config
+
+from ckanext.ands.controller import (
+    MintError, error_text, get_xml_url, log_attempt, notify_requestors, request_mint, save_doi)
+from ckanext.ands.model import DoiMintJob, MintAttempt, lock_package_for_mint, package_doi
+
+log = logging.getLogger(__name__)
+
+# Seconds a worker has to finish a job before another may take it over
+JOB_LEASE = 600
+
+
+def get_max_attempts():
+    return int(config.get('ckanext.ands.mint_max_attempts', 5))
+
+
+def get_retry_delay():
+    return int(config.get('ckanext.ands.mint_retry_delay', 60))
+
+
+def claim_next_job():
+    """
+    Take the oldest job that is due, marking it as running
+    Running jobs whose lease has expired (their worker died) are picked up again.
+    @return: DoiMintJob or None if there's nothing to do
+    """
+    Session = model.Session
+    while True:
+        now = datetime.datetime.utcnow()
+        job = Session.query(DoiMintJob).filter(
+            DoiMintJob.status.in_([DoiMintJob.PENDING, DoiMintJob.RUNNING]),
+            DoiMintJob.next_attempt <= now,
+        ).order_by(DoiMintJob.next_attempt, DoiMintJob.id).first()
+        if job is None:
+            return None
+
+        # Only one worker gets to take the job as it was when we saw it
+        claimed = Session.query(DoiMintJob).filter_by(
+            id=job.id, status=job.status, next_attempt=job.next_attempt
+        ).update({
+            'status': DoiMintJob.RUNNING,
+            'next_attempt': now + datetime.timedelta(seconds=JOB_LEASE),
+        }, synchronize_session=False)
+        Session.commit()
+        if claimed:
+            Session.refresh(job)
+            return job
+
+
+def _finish(job, status, error=None, doi=None):
+    job.status = status
+    job.last_error = error
+    job.doi = doi
+    job.finished = datetime.datetime.utcnow()
+    model.Session.commit()
+
+
+def _retry(job, error):
+    job.attempts += 1
+    if job.attempts >= get_max_attempts():
+        log.error('Giving up minting DOI for %s after %s attempts: %s', job.package_id, job.attempts, error)
+        return _finish(job, DoiMintJob.FAILED, error)
+
+    delay = get_retry_delay() * 2 ** (job.attempts - 1)
+    log.warning('Minting DOI for %s failed, retrying in %ss: %s', job.package_id, delay, error)
+    job.status = DoiMintJob.PENDING
+    job.last_error = error
+    job.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+    model.Session.commit()
+
+
+def _save(context, job, dataset, doi):
+    # Held until save_doi commits, see dataset_doi_admin_process
+    lock_package_for_mint(job.package_id)
+    existing = package_doi(job.package_id)
+    if existing:
+        # Approved from the dataset page while this job was minting
+        if existing != doi:
+            log.warning('DOI %s minted for %s is unused, the dataset was given %s meanwhile',
+                        doi, job.package_id, existing)
+        return _finish(job, DoiMintJob.DONE, 'Dataset already has a DOI', doi=existing)
+
+    # The job is done once the DOI is saved, emailing requestors can't undo that
+    save_doi(dict(context), dataset, doi, job.dataset_url, job.xml, notify=False)
+    _finish(job, DoiMintJob.DONE, doi=doi)
+    notify_requestors(job.package_id, job.dataset_url)
+
+
+def run_job(context, job):
+    """
+    Mint the DOI for a claimed job and save it on the dataset
+    """
+    try:
+        dataset = toolkit.get_action('package_show')(dict(context), {'id': job.package_id})
+    except toolkit.ObjectNotFound:
+        return _finish(job, DoiMintJob.FAILED, 'Dataset not found')
+    if dataset.get('doi_id'):
+        return _finish(job, DoiMintJob.DONE, 'Dataset already has a DOI', doi=dataset['doi_id'])
+
+    if job.doi:
+        # Minted by a worker that died before saving it
+        return _save(context, job, dataset, job.doi)
+
+    try:
+        result = request_mint(get_xml_url(job.dataset_url), job.xml)
+    except MintError as exp:
+        log_attempt(job.package_id, MintAttempt.MINT, error=exp)
+        # Network trouble or a garbled response, worth another go
+        return _retry(job, error_text(exp))
+
+    log_attempt(job.package_id, MintAttempt.MINT, result)
+    if not result.minted:
+        # ANDS understood and refused, retrying won't help
+        return _finish(job, DoiMintJob.FAILED, result.error_message())
+
+    doi = result.doi
+    # Record the DOI before touching the dataset so it's never lost
+    job.doi = doi
+    model.Session.commit()
+
+    _save(context, job, dataset, doi)
+    log.info('Minted DOI %s for %s', doi, job.package_id)
+
+
+def work(context, once=False, poll_interval=5):
+    """
+    Process queued jobs until interrupted
+    @param context: action context used to update datasets, must be a sysadmin
+    @param once: stop when the queue is empty instead of waiting for more
+    @param poll_interval: seconds to wait between checks of an empty queue
+    """
+    while True:
+        job = claim_next_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            run_job(context, job)
+        except Exception as exp:
+            log.exception('Unexpected error minting DOI for %s', job.package_id)
+            model.Session.rollback()
+            _finish(job, DoiMintJob.FAILED, error_text(exp), doi=job.doi)
@@ -0,0 +1,137 @@
+"""
+Load test the DOI approve flow end to end.
+
+For each dataset, as a sysadmin: fetch /dataset/<id>/doi_approve, post the XML
+it contains back, and check the dataset got a DOI. Run CKAN with
+ckanext.ands.service_url pointing at ``paster ands fake-ands`` so ANDS itself
+isn't touched, then::
+
+    python -m ckanext.ands.loadtest --url http://localhost:5000 --api-key KEY --create 200 -c 10
+
+Latency percentiles are reported for each step.
+"""
+import argparse
+import collections
+import re
+import sys
+import time
+import uuid
+from HTMLParser import HTMLParser
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+TEXTAREA_RE = re.compile(r'<textarea[^>]*name="xml"[^>]*>(.*?)</textarea>', re.DOTALL)
+
+
+def percentile(values, percent):
+    """
+    @param values: sorted list
+    @return: nearest rank percentile
+    """
+    if not values:
+        return 0.0
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class LoadTest(object):
+    def __init__(self, url, api_key):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = api_key
+        self.timings = collections.defaultdict(list)
+        self.statuses = collections.Counter()
+
+    def action(self, name, **data_dict):
+        resp = self.session.post('{}/api/3/action/{}'.format(self.url, name), json=data_dict)
+        resp.raise_for_status()
+        return resp.json()['result']
+
+    def create_datasets(self, number, owner_org):
+        prefix = 'ands-loadtest-{}'.format(uuid.uuid4().hex[:8])
+        return [
+            self.action('package_create', name='{}-{}'.format(prefix, i), title='Load test {}'.format(i),
+                        author='Load Test', notes='Created by ckanext.ands.loadtest',
+                        owner_org=owner_org)['name']
+            for i in xrange(number)
+        ]
+
+    def _timed(self, step, method, url, **kwargs):
+        start = time.time()
+        resp = self.session.request(method, url, allow_redirects=False, **kwargs)
+        self.timings[step].append(time.time() - start)
+        self.statuses['{} {}'.format(step, resp.status_code)] += 1
+        return resp
+
+    def approve(self, dataset_id):
+        """
+        @return: the DOI minted, or None
+        """
+        url = '{}/dataset/{}/doi_approve'.format(self.url, dataset_id)
+        start = time.time()
+        form = self._timed('form', 'GET', url)
+        match = TEXTAREA_RE.search(form.text)
+        if form.status_code != 200 or not match:
+            self.statuses['no form'] += 1
+            return None
+        xml = HTMLParser().unescape(match.group(1))
+        self._timed('submit', 'POST', url, data={'xml': xml, 'save': ''})
+        self.timings['total'].append(time.time() - start)
+
+        doi = self.action('package_show', id=dataset_id).get('doi_id')
+        self.statuses['minted' if doi else 'not minted'] += 1
+        return doi
+
+    def run(self, dataset_ids, concurrency):
+        pool = ThreadPool(concurrency)
+        try:
+            start = time.time()
+            results = pool.map(self.approve, dataset_ids)
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+        return results, elapsed
+
+    def report(self, elapsed, out=sys.stdout):
+        out.write('{:<8} {:>6} {:>8} {:>8} {:>8} {:>8}\n'.format('step', 'count', 'p50', 'p90', 'p99', 'max'))
+        for step in ('form', 'submit', 'total'):
+            values = sorted(self.timings[step])
+            if not values:
+                continue
+            out.write('{:<8} {:>6} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}\n'.format(
+                step, len(values), percentile(values, 50), percentile(values, 90),
+                percentile(values, 99), values[-1]))
+        for status, count in sorted(self.statuses.items()):
+            out.write('{}: {}\n'.format(status, count))
+        total = len(self.timings['total'])
+        if elapsed:
+            out.write('{} approvals in {:.1f}s, {:.1f}/second\n'.format(total, elapsed, total / elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('ids', nargs='*', help='Datasets to mint DOIs for')
+    parser.add_argument('--url', default='http://localhost:5000', help='CKAN site')
+    parser.add_argument('--api-key', required=True, help="A sysadmin's API key")
+    parser.add_argument('--create', type=int, default=0,
+                        help='Create this many public datasets to use instead')
+    parser.add_argument('--owner-org', help='Organization for created datasets')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    test = LoadTest(args.url, args.api_key)
+    ids = args.ids
+    if args.create:
+        ids = test.create_datasets(args.create, args.owner_org)
+    if not ids:
+        parser.error('Give dataset ids or --create')
+
+    results, elapsed = test.run(ids, args.concurrency)
+    test.report(elapsed)
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+"""
+Queued email, sent by ``paster ands mail-worker``.
+
+Used instead of sending inline when ckanext.ands.async_mail is enabled. Each
+flush sends everything that's due over a single SMTP connection, messages
+with several recipients go out as one SMTP transaction.
+"""
+import datetime
+import json
+import logging
+import smtplib
+import socket
+import time
+from email import Utils
+from email.header import Header
+from email.mime.text import MIMEText
+
+import ckan
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+from pylons import config
+
+from ckanext.ands.model import QueuedMail
+
+log = logging.getLogger(__name__)
+
+
+def async_mail_enabled():
+    return toolkit.asbool(config.get('ckanext.ands.async_mail', False))
+
+
+def get_max_attempts():
+    return int(config.get('ckanext.ands.mail_max_attempts', 5))
+
+
+def get_retry_delay():
+    return int(config.get('ckanext.ands.mail_retry_delay', 60))
+
+
+def queue_mail(recipients, subject, body):
+    """
+    Queue one message to be sent to all the recipients. Not committed.
+    @param recipients: list of (name, email) pairs
+    """
+    mail = QueuedMail(recipients=json.dumps([list(r) for r in recipients]), subject=subject, body=body)
+    model.Session.add(mail)
+    return mail
+
+
+def _format_message(mail, mail_from):
+    # Matches the headers ckan.lib.mailer uses
+    recipients = json.loads(mail.recipients)
+    msg = MIMEText(mail.body.encode('utf-8'), 'plain', 'utf-8')
+    msg['Subject'] = Header(mail.subject, 'utf-8')
+    msg['From'] = u"%s <%s>" % (config.get('ckan.site_title'), mail_from)
+    msg['To'] = Header(u', '.join(u"%s <%s>" % (name, email) for name, email in recipients), 'utf-8')
+    msg['Date'] = Utils.formatdate(time.time())
+    msg['X-Mailer'] = "CKAN %s" % ckan.__version__
+    return [email for name, email in recipients], msg.as_string()
+
+
+def _connect():
+    # Same settings as ckan.lib.mailer
+    if 'smtp.test_server' in config:
+        server = config['smtp.test_server']
+        starttls = False
+        user = password = None
+    else:
+        server = config.get('smtp.server', 'localhost')
+        starttls = toolkit.asbool(config.get('smtp.starttls'))
+        user = config.get('smtp.user')
+        password = config.get('smtp.password')
+
+    smtp = smtplib.SMTP()
+    smtp.connect(server)
+    smtp.ehlo()
+    if starttls:
+        smtp.starttls()
+        smtp.ehlo()
+    if user:
+        smtp.login(user, password)
+    return smtp
+
+
+def _retry(mail, error):
+    mail.attempts += 1
+    mail.last_error = str(error)
+    if mail.attempts >= get_max_attempts():
+        log.error('Giving up sending "%s" to %s: %s', mail.subject, mail.recipients, error)
+        mail.status = QueuedMail.FAILED
+    else:
+        delay = get_retry_delay() * 2 ** (mail.attempts - 1)
+        mail.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+
+
+def flush(limit=100):
+    """
+    Send queued mail that is due, over one SMTP connection
+    @param limit: most messages to send
+    @return: number of messages sent
+    """
+    Session = model.Session
+    # Locked until commit so concurrent workers don't send the same message
+    messages = Session.query(QueuedMail).filter(
+        QueuedMail.status == QueuedMail.PENDING,
+        QueuedMail.next_attempt <= datetime.datetime.utcnow(),
+    ).order_by(QueuedMail.id).limit(limit).with_for_update().all()
+    if not messages:
+        Session.commit()
+        return 0
+
+    try:
+        smtp = _connect()
+    except (socket.error, smtplib.SMTPException) as exp:
+        log.warning('Could not connect to the mail server: %s', exp)
+        for mail in messages:
+            _retry(mail, exp)
+        Session.commit()
+        return 0
+
+    mail_from = config.get('smtp.mail_from')
+    sent = 0
+    try:
+        for mail in messages:
+            try:
+                to_addrs, msg = _format_message(mail, mail_from)
+                smtp.sendmail(mail_from, to_addrs, msg)
+            except (socket.error, smtplib.SMTPException) as exp:
+                _retry(mail, exp)
+            else:
+                mail.status = QueuedMail.SENT
+                mail.sent = datetime.datetime.utcnow()
+                sent += 1
+    finally:
+        try:
+            smtp.quit()
+        except (socket.error, smtplib.SMTPException):
+            pass
+        Session.commit()
+    return sent
+
+
+def work(once=False, poll_interval=5):
+    """
+    Send queued mail until interrupted
+    @param once: stop when the queue is empty instead of waiting for more
+    @param poll_interval: seconds to wait between checks of an empty queue
+    """
+    while True:
+        if not flush() and once:
+            return
+        if not once:
+            time.sleep(poll_interval)
@@ -0,0 +1,112 @@
+"""
+Lightweight timing and counter metrics.
+
+By default everything is recorded to an in-memory sink holding the most recent
+values for each metric, which is enough for tests and for eyeballing from a
+shell. Set ckanext.ands.statsd_host to send them to statsd instead.
+"""
+import functools
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Recent timings kept per metric
+MAX_SAMPLES = 1000
+
+
+class MemorySink(object):
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.timings = defaultdict(lambda: deque(maxlen=self.max_samples))
+            self.counters = defaultdict(int)
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings[name].append(seconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] += count
+
+
+class StatsdSink(object):
+    """
+    Sends metrics to statsd over UDP, timings in milliseconds
+    Sending never blocks or raises, metrics that can't be sent are dropped.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='ckan.'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, stat):
+        try:
+            self._socket.sendto((self.prefix + stat).encode('utf-8'), self.address)
+        except (socket.error, UnicodeError) as exp:
+            log.debug('Could not send %s to statsd: %s', stat, exp)
+
+    def timing(self, name, seconds):
+        self._send('{}:{:.3f}|ms'.format(name, seconds * 1000))
+
+    def incr(self, name, count=1):
+        self._send('{}:{}|c'.format(name, count))
+
+
+_sink = MemorySink()
+
+
+def configure(config):
+    host = config.get('ckanext.ands.statsd_host')
+    if host:
+        set_sink(StatsdSink(host, int(config.get('ckanext.ands.statsd_port', 8125)),
+                            config.get('ckanext.ands.statsd_prefix', 'ckan.')))
+
+
+def get_sink():
+    return _sink
+
+
+def set_sink(sink):
+    global _sink
+    _sink = sink
+
+
+def timing(name, seconds):
+    _sink.timing(name, seconds)
+
+
+def incr(name, count=1):
+    _sink.incr(name, count)
+
+
+@contextmanager
+def timer(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        timing(name, time.time() - start)
+
+
+def timed(name):
+    """
+    Decorator recording how long each call takes
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
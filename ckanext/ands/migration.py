@@ -0,0 +1,209 @@
+"""
+Versioned schema changes for the extension's tables.
+
+The version reached is kept in ands_schema_version. Each migration runs once,
+in order, inside the same transaction as the version bump. Migrations must
+cope with tables created from the current model definitions (a fresh install
+creates them in the first migration), so they check before altering.
+"""
+import logging
+
+from ckan.model import meta, PackageExtra
+from sqlalchemy import Table, Column, types, func, inspect, select
+from sqlalchemy.exc import ProgrammingError
+
+from ckanext.ands.model import (
+    RATE_LIMIT_NAME, doi_mint_job_table, doi_request_table, mail_queue_table, mint_attempt_table,
+    package_doi_table, rate_limit_table)
+
+log = logging.getLogger(__name__)
+
+# Arbitrary key for the advisory lock held while migrating
+LOCK_KEY = 0x616e6473
+
+# Version found by check_version
+_checked_version = None
+
+schema_version_table = Table(
+    'ands_schema_version', meta.metadata,
+    Column('version', types.Integer, nullable=False),
+)
+
+
+def _columns(connection, table_name):
+    return set(column['name'] for column in inspect(connection).get_columns(table_name))
+
+
+def _create_index(connection, table, name):
+    for index in table.indexes:
+        if index.name == name:
+            index.create(connection)
+
+
+def populate_package_dois(connection):
+    """
+    Fill package_dois from the doi_id extras of existing datasets
+    """
+    extras = select(
+        [PackageExtra.package_id, PackageExtra.value]
+    ).where(
+        PackageExtra.key == u'doi_id'
+    ).where(
+        PackageExtra.state == u'active'
+    ).where(
+        PackageExtra.value != u''
+    ).distinct(PackageExtra.value)
+    connection.execute(package_doi_table.delete())
+    connection.execute(package_doi_table.insert().from_select(['package_id', 'doi'], extras))
+
+
+def create_tables(connection):
+    """
+    Everything up to versioned migrations, which earlier releases set up at startup
+    """
+    for table in (doi_request_table, doi_mint_job_table, mail_queue_table):
+        table.create(connection, checkfirst=True)
+
+    if not package_doi_table.exists(connection):
+        package_doi_table.create(connection)
+        populate_package_dois(connection)
+
+    if 'status' not in _columns(connection, 'doi_requests'):
+        connection.execute("ALTER TABLE doi_requests ADD COLUMN status text NOT NULL DEFAULT 'pending'")
+        connection.execute("ALTER TABLE doi_requests ADD COLUMN created timestamp NOT NULL DEFAULT now()")
+        # Requests for datasets that already have a DOI were approved
+        connection.execute("UPDATE doi_requests SET status = 'approved' "
+                           "WHERE package_id IN (SELECT package_id FROM package_dois)")
+        _create_index(connection, doi_request_table, 'idx_doi_requests_status_created')
+        _create_index(connection, doi_request_table, 'idx_doi_requests_created')
+
+
+def add_doi_request_lifecycle(connection):
+    """
+    updated, resolved and doi columns on doi_requests
+    """
+    if 'resolved' in _columns(connection, 'doi_requests'):
+        return
+    connection.execute("ALTER TABLE doi_requests ADD COLUMN updated timestamp")
+    connection.execute("ALTER TABLE doi_requests ADD COLUMN resolved timestamp")
+    connection.execute("ALTER TABLE doi_requests ADD COLUMN doi text")
+    # When earlier requests were approved wasn't recorded, but their DOI is known
+    connection.execute("UPDATE doi_requests SET doi = package_dois.doi FROM package_dois "
+                       "WHERE doi_requests.package_id = package_dois.package_id "
+                       "AND doi_requests.status = 'approved'")
+    _create_index(connection, doi_request_table, 'idx_doi_requests_resolved')
+
+
+def add_package_doi_xml_hash(connection):
+    """
+    xml_hash column on package_dois, for syncing metadata changes to ANDS
+    """
+    if 'xml_hash' in _columns(connection, 'package_dois'):
+        return
+    # Left empty, so the first resync sends everything
+    connection.execute("ALTER TABLE package_dois ADD COLUMN xml_hash text")
+
+
+def add_package_doi_xml(connection):
+    """
+    xml and xml_modified columns on package_dois, the XML last sent to ANDS
+    """
+    if 'xml_modified' in _columns(connection, 'package_dois'):
+        return
+    connection.execute("ALTER TABLE package_dois ADD COLUMN xml text")
+    connection.execute("ALTER TABLE package_dois ADD COLUMN xml_modified timestamp")
+
+
+def create_mint_attempts(connection):
+    """
+    doi_mint_attempts, a log of every call to ANDS
+    """
+    mint_attempt_table.create(connection, checkfirst=True)
+
+
+def add_mint_attempt_idempotency_key(connection):
+    """
+    idempotency_key column on doi_mint_attempts
+    """
+    if 'idempotency_key' in _columns(connection, 'doi_mint_attempts'):
+        return
+    connection.execute("ALTER TABLE doi_mint_attempts ADD COLUMN idempotency_key text")
+    _create_index(connection, mint_attempt_table, 'idx_doi_mint_attempts_idempotency_key')
+
+
+def create_rate_limit(connection):
+    """
+    ands_rate_limit, the token bucket for ckanext.ands.rate_limit
+    """
+    rate_limit_table.create(connection, checkfirst=True)
+    if not connection.execute(select([func.count()]).select_from(rate_limit_table)).scalar():
+        connection.execute(rate_limit_table.insert().values(
+            name=RATE_LIMIT_NAME, tokens=0, updated=func.now()))
+
+
+# In order, never reorder or remove entries, only append
+MIGRATIONS = [
+    create_tables,
+    add_doi_request_lifecycle,
+    add_package_doi_xml_hash,
+    add_package_doi_xml,
+    create_mint_attempts,
+    add_mint_attempt_idempotency_key,
+    create_rate_limit,
+]
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def current_version(connection):
+    """
+    @return: version the database is at, 0 if never migrated
+    """
+    if not schema_version_table.exists(connection):
+        return 0
+    version = connection.execute(select([schema_version_table.c.version])).scalar()
+    return version or 0
+
+
+def upgrade():
+    """
+    Run any migrations the database hasn't had yet
+    @return: the version migrated to
+    """
+    with meta.engine.begin() as connection:
+        # Only one process migrates at a time, the rest wait then find nothing to do
+        connection.execute(select([func.pg_advisory_xact_lock(LOCK_KEY)]))
+
+        schema_version_table.create(connection, checkfirst=True)
+        version = current_version(connection)
+        for number, migration in enumerate(MIGRATIONS, 1):
+            if number > version:
+                log.info('Running ckanext-ands migration %s: %s', number, migration.__name__)
+                migration(connection)
+
+        if version < LATEST_VERSION:
+            connection.execute(schema_version_table.delete())
+            connection.execute(schema_version_table.insert().values(version=LATEST_VERSION))
+
+    global _checked_version
+    _checked_version = max(version, LATEST_VERSION)
+    return _checked_version
+
+
+def check_version():
+    """
+    Warn if the database needs migrating, checked once per process with a single query
+    @return: the database's version
+    """
+    global _checked_version
+    if _checked_version is None:
+        try:
+            with meta.engine.connect() as connection:
+                _checked_version = connection.execute(select([schema_version_table.c.version])).scalar() or 0
+        except ProgrammingError:
+            # No version table, never migrated
+            _checked_version = 0
+        if _checked_version < LATEST_VERSION:
+            log.warning('ckanext-ands tables are at version %s, %s is needed. '
+                        'Run "paster --plugin=ckanext-ands ands initdb"', _checked_version, LATEST_VERSION)
+    return _checked_version
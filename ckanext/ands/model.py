@@ -1,8 +1,16 @@
-from ckan.model import meta, Package
+import datetime
+
+from ckan.model import meta, Member, Package, PackageExtra, Session, User
 from ckan.model.domain_object import DomainObject
-from sqlalchemy import Table, Column, types, ForeignKey, UniqueConstraint
+from sqlalchemy import (
+    Table, Column, types, ForeignKey, UniqueConstraint, Index, extract, func, or_, select, tuple_)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import relation, backref
 
+# First half of the advisory lock key taken while minting for a dataset, the
+# second half is a hash of the dataset's id
+MINT_LOCK_CLASS = 0x616e64
+
 doi_request_table = Table(
     'doi_requests', meta.metadata,
     Column('id', types.Integer, primary_key=True),
@@ -24,6 +32,18 @@ doi_request_table = Table(
     Column('doi_description', types.UnicodeText, nullable=True),
     Column('message_to_admin_optional', types.UnicodeText, nullable=True),
 
+    Column('status', types.UnicodeText, nullable=False, default=u'pending', server_default=u'pending'),
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow,
+           server_default=func.now()),
+    Column('updated', types.DateTime, nullable=True, onupdate=datetime.datetime.utcnow),
+    # When the request was approved, and the DOI it got
+    Column('resolved', types.DateTime, nullable=True),
+    Column('doi', types.UnicodeText, nullable=True),
+
+    # Lookups by package_id use the unique constraint's index
+    Index('idx_doi_requests_status_created', 'status', 'created'),
+    Index('idx_doi_requests_created', 'created'),
+    Index('idx_doi_requests_resolved', 'resolved'),
 )
 
 
@@ -31,7 +51,8 @@ class DoiRequest(DomainObject):
     """
     DOI Request
     """
-    pass
+    PENDING = u'pending'
+    APPROVED = u'approved'
 
 meta.mapper(DoiRequest, doi_request_table, properties={
     'dataset': relation(
@@ -39,4 +60,467 @@ meta.mapper(DoiRequest, doi_request_table, properties={
         backref=backref('doi_request', cascade='all, delete-orphan'),
         primaryjoin=doi_request_table.c.package_id.__eq__(Package.id)
     )
-})
\ No newline at end of file
+})
+
+doi_mint_job_table = Table(
+    'doi_mint_jobs', meta.metadata,
+    Column('id', types.Integer, primary_key=True),
+
+    Column(
+        'package_id', types.UnicodeText,
+        ForeignKey('package.id', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False),
+    # The sysadmin who approved the DOI
+    Column(
+        'user_id', types.UnicodeText,
+        ForeignKey('user.id', onupdate='CASCADE', ondelete='SET NULL'),
+        nullable=True),
+
+    Column('dataset_url', types.UnicodeText, nullable=False),
+    Column('xml', types.UnicodeText, nullable=False),
+
+    Column('status', types.UnicodeText, nullable=False, default=u'pending'),
+    Column('attempts', types.Integer, nullable=False, default=0),
+    Column('last_error', types.UnicodeText, nullable=True),
+    Column('doi', types.UnicodeText, nullable=True),
+
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Column('next_attempt', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Column('finished', types.DateTime, nullable=True),
+
+    Index('idx_doi_mint_jobs_status_next_attempt', 'status', 'next_attempt'),
+    Index('idx_doi_mint_jobs_package_id', 'package_id'),
+)
+
+
+class DoiMintJob(DomainObject):
+    """
+    A queued request to mint a DOI with ANDS
+    """
+    PENDING = u'pending'
+    RUNNING = u'running'
+    DONE = u'done'
+    FAILED = u'failed'
+
+meta.mapper(DoiMintJob, doi_mint_job_table)
+
+
+# DOI to dataset, kept in step with the doi_id extra by the plugin
+package_doi_table = Table(
+    'package_dois', meta.metadata,
+    Column(
+        'package_id', types.UnicodeText,
+        ForeignKey('package.id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True),
+    Column('doi', types.UnicodeText, nullable=False, unique=True),
+    # The DataCite XML ANDS was last sent, its hash, and the dataset's
+    # metadata_modified at the time, see ckanext.ands.sync
+    Column('xml', types.UnicodeText, nullable=True),
+    Column('xml_hash', types.UnicodeText, nullable=True),
+    Column('xml_modified', types.DateTime, nullable=True),
+)
+
+
+class PackageDoi(DomainObject):
+    """
+    The DOI of a dataset
+    """
+    pass
+
+meta.mapper(PackageDoi, package_doi_table)
+
+
+mail_queue_table = Table(
+    'doi_mail_queue', meta.metadata,
+    Column('id', types.Integer, primary_key=True),
+
+    # JSON list of [name, email] pairs, all sent the one message
+    Column('recipients', types.UnicodeText, nullable=False),
+    Column('subject', types.UnicodeText, nullable=False),
+    Column('body', types.UnicodeText, nullable=False),
+
+    Column('status', types.UnicodeText, nullable=False, default=u'pending'),
+    Column('attempts', types.Integer, nullable=False, default=0),
+    Column('last_error', types.UnicodeText, nullable=True),
+
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Column('next_attempt', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Column('sent', types.DateTime, nullable=True),
+
+    Index('idx_doi_mail_queue_status_next_attempt', 'status', 'next_attempt'),
+)
+
+
+class QueuedMail(DomainObject):
+    """
+    An email waiting to be sent
+    """
+    PENDING = u'pending'
+    SENT = u'sent'
+    FAILED = u'failed'
+
+meta.mapper(QueuedMail, mail_queue_table)
+
+
+mint_attempt_table = Table(
+    'doi_mint_attempts', meta.metadata,
+    Column('id', types.Integer, primary_key=True),
+
+    Column(
+        'package_id', types.UnicodeText,
+        ForeignKey('package.id', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False),
+    Column('operation', types.UnicodeText, nullable=False),
+    # None when ANDS couldn't be reached or its response understood
+    Column('responsecode', types.UnicodeText, nullable=True),
+    Column('success', types.Boolean, nullable=False),
+    Column('doi', types.UnicodeText, nullable=True),
+    Column('message', types.UnicodeText, nullable=True),
+    # Seconds the round trip to ANDS took
+    Column('elapsed', types.Float, nullable=True),
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    # Sent with the approve form, the same for resubmissions of it
+    Column('idempotency_key', types.UnicodeText, nullable=True),
+
+    Index('idx_doi_mint_attempts_created', 'created'),
+    Index('idx_doi_mint_attempts_package_id', 'package_id'),
+    Index('idx_doi_mint_attempts_idempotency_key', 'idempotency_key'),
+)
+
+
+class MintAttempt(DomainObject):
+    """
+    A call to ANDS to mint a DOI or update its metadata, and how it went
+    """
+    MINT = u'mint'
+    UPDATE = u'update'
+
+meta.mapper(MintAttempt, mint_attempt_table)
+
+
+# Token bucket shared by every process calling ANDS, see client.wait_for_rate_limit
+rate_limit_table = Table(
+    'ands_rate_limit', meta.metadata,
+    Column('name', types.UnicodeText, primary_key=True),
+    Column('tokens', types.Float, nullable=False),
+    Column('updated', types.DateTime, nullable=False),
+)
+
+RATE_LIMIT_NAME = u'ands'
+
+
+def take_rate_limit_token(rate, burst):
+    """
+    Take a token from the shared bucket, refilled at rate per second up to burst.
+    The bucket starts full if its row is missing. Runs in its own transaction.
+    @return: whether a token was available
+    """
+    refilled = func.least(
+        burst,
+        rate_limit_table.c.tokens + extract('epoch', func.now() - rate_limit_table.c.updated) * rate)
+    with meta.engine.begin() as connection:
+        taken = connection.execute(rate_limit_table.update().where(
+            rate_limit_table.c.name == RATE_LIMIT_NAME
+        ).where(
+            refilled >= 1
+        ).values(
+            tokens=refilled - 1,
+            updated=func.now(),
+        )).rowcount
+        if taken:
+            return True
+        exists = connection.execute(select([rate_limit_table.c.name]).where(
+            rate_limit_table.c.name == RATE_LIMIT_NAME)).first()
+    if exists:
+        return False
+
+    # Not INSERT ... ON CONFLICT, older PostgreSQL versions supported by CKAN lack it
+    try:
+        with meta.engine.begin() as connection:
+            connection.execute(rate_limit_table.insert().values(
+                name=RATE_LIMIT_NAME, tokens=max(0, burst - 1), updated=func.now()))
+    except IntegrityError:
+        # Added by another process meanwhile
+        return take_rate_limit_token(rate, burst)
+    return True
+
+
+def lock_package_for_mint(package_id):
+    """
+    Take the lock on minting a DOI for a dataset, held until the transaction ends
+    Anyone else minting for the same dataset waits here until then.
+    """
+    Session.execute(select([func.pg_advisory_xact_lock(MINT_LOCK_CLASS, func.hashtext(package_id))]))
+
+
+def minted_doi_for_key(package_id, idempotency_key):
+    """
+    The DOI an earlier attempt with the same idempotency key minted
+    @return: the DOI, or None if no attempt with the key succeeded
+    """
+    if not idempotency_key:
+        return None
+    row = Session.query(MintAttempt.doi).filter(
+        MintAttempt.package_id == package_id,
+        MintAttempt.idempotency_key == idempotency_key,
+        MintAttempt.operation == MintAttempt.MINT,
+        MintAttempt.success == True,
+    ).first()
+    return row[0] if row else None
+
+
+def enqueue_mint_job(package_id, dataset_url, xml, user_id=None):
+    """
+    Queue a DOI mint for a dataset
+    @return: the new DoiMintJob, or None if the dataset already has a DOI or one queued
+    """
+    # So two approvals at once can't both find nothing queued
+    lock_package_for_mint(package_id)
+    in_flight = Session.query(DoiMintJob).filter(
+        DoiMintJob.package_id == package_id,
+        DoiMintJob.status.in_([DoiMintJob.PENDING, DoiMintJob.RUNNING]))
+    ((exists, ),) = Session.query(in_flight.exists())
+    if exists or package_doi(package_id):
+        # Releases the lock
+        Session.commit()
+        return None
+
+    job = DoiMintJob(package_id=package_id, dataset_url=dataset_url, xml=xml, user_id=user_id)
+    Session.add(job)
+    Session.commit()
+    return job
+
+
+def iter_public_datasets(batch_size=1000, session=None):
+    """
+    Iterate over the fields needed for DataCite XML of every public dataset, of any type
+    Rows are fetched through a server side cursor, batch_size at a time, so
+    memory use doesn't grow with the size of the catalogue.
+    @param session: to read with instead of the scoped Session
+    @return: generator of dicts with name, author, title, notes, metadata_created
+        and doi, None if the dataset hasn't got one
+    """
+    q = (session or Session).query(
+        Package.name, Package.author, Package.title, Package.notes, Package.metadata_created, PackageDoi.doi
+    ).outerjoin(
+        PackageDoi, PackageDoi.package_id == Package.id
+    ).filter(
+        Package.state == u'active',
+        Package.private == False,
+    ).order_by(Package.id).execution_options(stream_results=True).yield_per(batch_size)
+
+    for name, author, title, notes, metadata_created, doi in q:
+        yield {
+            'name': name,
+            'author': author,
+            'title': title,
+            'notes': notes,
+            'metadata_created': metadata_created,
+            'doi': doi,
+        }
+
+
+def user_member_of(user_id, group_ids):
+    """
+    Which of the groups or orgs the user is an active member of, in any capacity
+    @return: set of group ids
+    """
+    if not group_ids:
+        return set()
+    q = Session.query(Member.group_id).filter(
+        Member.table_name == u'user',
+        Member.table_id == user_id,
+        Member.state == u'active',
+        Member.group_id.in_(list(group_ids)))
+    return set(group_id for (group_id, ) in q)
+
+
+def groups_with_parents(group_ids):
+    """
+    Which of the groups or orgs sit below another in the group hierarchy
+    @return: set of group ids
+    """
+    if not group_ids:
+        return set()
+    q = Session.query(Member.table_id).filter(
+        Member.table_name == u'group',
+        Member.capacity == u'parent',
+        Member.state == u'active',
+        Member.table_id.in_(list(group_ids)))
+    return set(group_id for (group_id, ) in q)
+
+
+def package_doi(id_or_name):
+    """
+    The DOI of a dataset, read straight from its extras
+    @return: the doi_id, or None if it hasn't got one (or doesn't exist)
+    """
+    row = Session.query(PackageExtra.value).join(
+        Package, Package.id == PackageExtra.package_id
+    ).filter(
+        or_(Package.id == id_or_name, Package.name == id_or_name),
+        PackageExtra.key == u'doi_id',
+        PackageExtra.state == u'active',
+    ).first()
+    return row[0] if row else None
+
+
+def package_id_for_doi(doi):
+    """
+    @return: id of the dataset with this DOI, or None
+    """
+    row = Session.query(PackageDoi.package_id).filter(PackageDoi.doi == doi).first()
+    return row[0] if row else None
+
+
+def set_package_doi(package_id, doi):
+    """
+    Record the DOI of a dataset, or that it has none. Not committed.
+    """
+    existing = Session.query(PackageDoi).get(package_id)
+    if not doi:
+        if existing is not None:
+            Session.delete(existing)
+    elif existing is None:
+        Session.add(PackageDoi(package_id=package_id, doi=doi))
+    elif existing.doi != doi:
+        existing.doi = doi
+
+
+def doi_request_exists(id_or_name, user_id):
+    """
+    Whether the user has already requested a DOI for the dataset, in one query
+    @param id_or_name: package id or name
+    """
+    q = Session.query(DoiRequest).join(
+        Package, Package.id == DoiRequest.package_id
+    ).filter(
+        or_(Package.id == id_or_name, Package.name == id_or_name),
+        DoiRequest.user_id == user_id,
+    )
+    ((exists, ),) = Session.query(q.exists())
+    return exists
+
+
+def add_doi_request(**values):
+    """
+    Add a DOI request, unless the user already has one for the dataset. Not committed.
+    Relies on the unique constraint rather than checking first, so concurrent
+    requests from the same user can't both get in.
+    @return: the new DoiRequest, or None if there already was one
+    """
+    doi_request = DoiRequest(**values)
+    Session.begin_nested()
+    try:
+        Session.add(doi_request)
+        # Only releases the savepoint
+        Session.commit()
+    except IntegrityError:
+        Session.rollback()
+        return None
+    return doi_request
+
+
+def set_sent_xml(package_id, xml, xml_hash, metadata_modified):
+    """
+    Record the XML ANDS now has for a dataset's DOI. Not committed.
+    @param metadata_modified: the dataset's, when the XML was built
+    """
+    Session.query(PackageDoi).filter(
+        PackageDoi.package_id == package_id
+    ).update({
+        'xml': xml,
+        'xml_hash': xml_hash,
+        'xml_modified': metadata_modified,
+    }, synchronize_session=False)
+
+
+def iter_package_dois(batch_size=1000):
+    """
+    Iterate over every active dataset with a DOI, with the fields needed for its DataCite XML
+    @return: generator of dicts with id, name, author, title, notes, metadata_created,
+        metadata_modified, doi, xml_hash and xml_modified
+    """
+    q = Session.query(
+        Package.id, Package.name, Package.author, Package.title, Package.notes, Package.metadata_created,
+        Package.metadata_modified, PackageDoi.doi, PackageDoi.xml_hash, PackageDoi.xml_modified
+    ).join(
+        PackageDoi, PackageDoi.package_id == Package.id
+    ).filter(
+        Package.state == u'active',
+    ).order_by(Package.id).execution_options(stream_results=True).yield_per(batch_size)
+
+    keys = ('id', 'name', 'author', 'title', 'notes', 'metadata_created', 'metadata_modified', 'doi',
+            'xml_hash', 'xml_modified')
+    for row in q:
+        yield dict(zip(keys, row))
+
+
+def requestor_contacts(package_id):
+    """
+    Who to tell when a dataset's DOI is approved, in one query
+    @return: list of (display name, email) for each requestor with an email address
+    """
+    q = Session.query(User).join(
+        DoiRequest, DoiRequest.user_id == User.id
+    ).filter(
+        DoiRequest.package_id == package_id,
+        User.email != None,
+        User.email != u'',
+    ).order_by(DoiRequest.id)
+    return [(user.display_name, user.email) for user in q]
+
+
+def approve_doi_requests(package_id, doi):
+    """
+    Mark the pending requests for a dataset as approved with the minted DOI. Not committed.
+    """
+    now = datetime.datetime.utcnow()
+    Session.query(DoiRequest).filter_by(
+        package_id=package_id, status=DoiRequest.PENDING
+    ).update({
+        'status': DoiRequest.APPROVED,
+        'doi': doi,
+        'resolved': now,
+        'updated': now,
+    }, synchronize_session=False)
+
+
+def mint_attempt_counts(since=None, operation=None):
+    """
+    How often each ANDS response code came back, to follow failure rates
+    @param since: only count attempts made since this datetime
+    @param operation: MintAttempt.MINT or MintAttempt.UPDATE, default both
+    @return: dict of response code (None where ANDS wasn't reached) to count
+    """
+    q = Session.query(MintAttempt.responsecode, func.count(MintAttempt.id))
+    if since is not None:
+        q = q.filter(MintAttempt.created >= since)
+    if operation is not None:
+        q = q.filter(MintAttempt.operation == operation)
+    return dict(q.group_by(MintAttempt.responsecode))
+
+
+def list_doi_requests(status=None, owner_org=None, created_after=None, created_before=None,
+                      marker=None, limit=50):
+    """
+    DOI requests, newest first, with the dataset and requesting user
+    Paged by keyset, pass (created, id) of the last request seen as marker to get the next page.
+    @return: list of (DoiRequest, Package, User)
+    """
+    q = Session.query(DoiRequest, Package, User).join(
+        Package, Package.id == DoiRequest.package_id
+    ).join(
+        User, User.id == DoiRequest.user_id
+    )
+    if status:
+        q = q.filter(DoiRequest.status == status)
+    if owner_org:
+        q = q.filter(Package.owner_org == owner_org)
+    if created_after:
+        q = q.filter(DoiRequest.created >= created_after)
+    if created_before:
+        q = q.filter(DoiRequest.created < created_before)
+    if marker:
+        q = q.filter(tuple_(DoiRequest.created, DoiRequest.id) < tuple_(*marker))
+    return q.order_by(DoiRequest.created.desc(), DoiRequest.id.desc()).limit(limit).all()
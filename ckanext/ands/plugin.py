@@ -1,10 +1,14 @@
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
-from ckan.model import package_table
 
+import datacite
 import helpers as h
-from auth import package_delete
-from model import doi_request_table
+import actions
+import auth
+import metrics
+import migration
+from model import set_package_doi
+from validators import doi_unique
 
 
 class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
@@ -15,11 +19,15 @@ class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.ITemplateHelpers, inherit=True)
     plugins.implements(plugins.IAuthFunctions, inherit=True)
+    plugins.implements(plugins.IActions)
 
     # IConfigurable
     def configure(self, config):
-        if package_table.exists():
-            doi_request_table.create(checkfirst=True)
+        datacite.configure(config)
+        h.configure(config)
+        metrics.configure(config)
+        # Tables are set up by paster ands initdb, just make sure that's been run
+        migration.check_version()
 
     # IConfigurer
 
@@ -29,7 +37,20 @@ class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         toolkit.add_resource('fanstatic', 'ands')
 
     # IRoutes
+    def before_map(self, map):
+        # Core's /ckan-admin/{action} would match it first otherwise
+        map.connect(
+            '/ckan-admin/doi_requests', action='index',
+            controller='ckanext.ands.controller:DoiRequestAdminController')
+        return map
+
     def after_map(self, map):
+        map.connect(
+            '/doi/{doi:.*}', action='doi_redirect',
+            controller='ckanext.ands.controller:DatasetDoiController')
+        map.connect(
+            '/ands/datacite.xml', action='datacite_export',
+            controller='ckanext.ands.controller:DatasetDoiController')
         map.connect(
             '/dataset/{id}/doi', action='dataset_doi',
             controller='ckanext.ands.controller:DatasetDoiController')
@@ -45,6 +66,7 @@ class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             'doi_id': [
                 toolkit.get_converter('ignore_missing'),
                 toolkit.get_converter('ignore_not_sysadmin'),
+                doi_unique,
                 toolkit.get_converter('convert_to_extras'),
             ]
         })
@@ -78,11 +100,43 @@ class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         return []
 
     # IPackageController
+    def _sync_doi(self, entity):
+        doi = None
+        for extra in entity.extras_list:
+            if extra.key == 'doi_id' and extra.state == 'active':
+                doi = extra.value
+        set_package_doi(entity.id, doi)
+
+    def create(self, entity):
+        self._sync_doi(entity)
+
     def edit(self, entity):
         # DOI key shouldn't be deleted!
         for extra in entity.extras_list:
             if extra.key == 'doi_id' and extra.value is not None:
                 extra.state = 'active'
+        self._sync_doi(entity)
+        h.invalidate_package_citation(entity.id)
+
+    def after_update(self, context, pkg_dict):
+        h.invalidate_package_citation(pkg_dict['id'])
+        h.invalidate_package_has_doi(pkg_dict)
+        sync_on_update = toolkit.asbool(toolkit.config.get('ckanext.ands.sync_on_update', False))
+        if sync_on_update and not context.get('ands_skip_sync'):
+            # Imported here, it needs the controller and requests
+            from ckanext.ands.sync import sync_package
+            sync_package(pkg_dict['id'])
+
+    def after_delete(self, context, pkg_dict):
+        h.invalidate_package_citation(pkg_dict['id'])
+
+    def before_index(self, pkg_dict):
+        # So datasets with DOIs can be searched or faceted on has_doi
+        doi = pkg_dict.get('doi_id') or pkg_dict.get('extras_doi_id')
+        if doi:
+            pkg_dict['doi_id'] = doi
+        pkg_dict['has_doi'] = bool(doi)
+        return pkg_dict
 
     # ITemplateHelpers
     def get_helpers(self):
@@ -90,11 +144,25 @@ class AndsPlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             'package_get_year': h.package_get_year,
             'now': h.now,
             'get_site_title': h.get_site_title,
+            'package_citation': h.package_citation,
             'can_request_doi': h.can_request_doi,
+            'can_request_doi_for_packages': h.can_request_doi_for_packages,
+            'doi_mint_pending': h.doi_mint_pending,
         }
 
     # IAuthFunctions
     def get_auth_functions(self):
         return {
-            'package_delete': package_delete
+            'package_delete': auth.package_delete,
+            'doi_mint_batch': auth.doi_mint_batch,
+            'package_show_by_doi': auth.package_show_by_doi,
+            'doi_request_list': auth.doi_request_list,
+        }
+
+    # IActions
+    def get_actions(self):
+        return {
+            'doi_mint_batch': actions.doi_mint_batch,
+            'package_show_by_doi': actions.package_show_by_doi,
+            'doi_request_list': actions.doi_request_list,
         }
@@ -0,0 +1,140 @@
+"""
+Keep the metadata ANDS holds for minted DOIs in step with their datasets.
+
+The DataCite XML last sent for each DOI is kept in package_dois, with its hash
+and the dataset's metadata_modified at the time. Datasets not modified since
+aren't looked at further. Otherwise their XML is rebuilt, and only sent to
+ANDS's update call if it hashes differently, so editing fields that aren't in
+the XML costs nothing.
+"""
+import logging
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+import ckan.model as model
+
+from ckanext.ands import datacite
+from ckanext.ands.batch import dataset_url_for, get_batch_workers
+from ckanext.ands.controller import MintError, error_text, get_xml_url, log_attempt, record_sent_xml, request_update
+from ckanext.ands.model import MintAttempt, PackageDoi, iter_package_dois
+
+log = logging.getLogger(__name__)
+
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def _result(dataset, status, message):
+    return {'id': dataset['id'], 'doi': dataset['doi'], 'status': status, 'message': message}
+
+
+def _prepare(dataset, force=False):
+    """
+    @param dataset: dict as given by iter_package_dois
+    @return: xml to send, or None if ANDS is already up to date
+    """
+    if force:
+        return datacite.get_serializer().serialize(dataset, dataset['doi'])
+    if dataset['xml_modified'] is not None and dataset['xml_modified'] == dataset['metadata_modified']:
+        return None
+    xml = datacite.get_serializer().serialize(dataset, dataset['doi'])
+    if datacite.xml_hash(xml) == dataset['xml_hash']:
+        return None
+    return xml
+
+
+def _post(job):
+    dataset, xml = job
+    try:
+        return request_update(dataset['doi'], get_xml_url(dataset_url_for(dataset)), xml), None
+    except Exception as exp:
+        return None, exp
+
+
+def _apply(dataset, xml, result, error):
+    """
+    Record the XML sent if ANDS took the update. Not committed.
+    """
+    log_attempt(dataset['id'], MintAttempt.UPDATE, result, error)
+    if isinstance(error, MintError):
+        return _result(dataset, FAILED, error_text(error))
+    if error is not None:
+        return _result(dataset, FAILED, u'Error contacting DOI server: {}'.format(error_text(error)))
+
+    if not result.updated:
+        return _result(dataset, FAILED, result.error_message())
+
+    record_sent_xml(dataset['id'], xml)
+    return _result(dataset, UPDATED, 'DOI metadata updated')
+
+
+def sync_package(package_id, force=False):
+    """
+    Send a dataset's metadata to ANDS if it has a DOI and has changed since
+    last sent. Not committed, called during package_update.
+    @return: result dict (id, doi, status, message), or None if it has no DOI
+    """
+    package_doi = model.Session.query(PackageDoi).get(package_id)
+    if package_doi is None:
+        return None
+    pkg = model.Package.get(package_id)
+    dataset = {
+        'id': pkg.id,
+        'name': pkg.name,
+        'author': pkg.author,
+        'title': pkg.title,
+        'notes': pkg.notes,
+        'metadata_created': pkg.metadata_created,
+        'metadata_modified': pkg.metadata_modified,
+        'doi': package_doi.doi,
+        'xml_hash': package_doi.xml_hash,
+        'xml_modified': package_doi.xml_modified,
+    }
+
+    xml = _prepare(dataset, force)
+    if xml is None:
+        return _result(dataset, UNCHANGED, 'DOI metadata unchanged')
+    response, error = _post((dataset, xml))
+    result = _apply(dataset, xml, response, error)
+    if result['status'] == FAILED:
+        # Left for paster ands resync to retry, the hash still doesn't match
+        log.warning('Could not update DOI %s for %s: %s', dataset['doi'], package_id, result['message'])
+    return result
+
+
+def resync(force=False, workers=None, commit_every=100):
+    """
+    Send changed metadata for every dataset with a DOI to ANDS
+    @param force: send everything, changed or not
+    @param workers: maximum number of concurrent requests to ANDS
+    @param commit_every: hashes are committed after this many updates
+    @return: generator of result dicts (id, doi, status, message)
+    """
+    if workers is None:
+        workers = get_batch_workers()
+
+    # Only changed datasets are kept, and the catalogue is read before any
+    # commit so the server side cursor isn't disturbed
+    jobs = []
+    for dataset in iter_package_dois():
+        xml = _prepare(dataset, force)
+        if xml is None:
+            yield _result(dataset, UNCHANGED, 'DOI metadata unchanged')
+        else:
+            jobs.append((dataset, xml))
+
+    if not jobs:
+        return
+
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        responses = pool.imap(_post, jobs)
+        for count, ((dataset, xml), (response, error)) in enumerate(izip(jobs, responses), 1):
+            yield _apply(dataset, xml, response, error)
+            if count % commit_every == 0:
+                model.Session.commit()
+    finally:
+        model.Session.commit()
+        pool.close()
+        pool.join()
@@ -0,0 +1,364 @@
+"""Benchmarks for the extension's hot paths.
+
+Run with ``nosetests -s`` to see the figures.
+
+Every benchmark is timed against a slower way of doing the same thing in the
+same run (the legacy XML builder, dateutil, package_show, an uncached lookup)
+and fails unless it is faster by the expected factor, less
+ANDS_BENCHMARK_THRESHOLD (default 0.25, i.e. 25%). That needs no stored
+figures, so it holds on any machine.
+
+Figures can also be recorded in benchmark_baselines.json with
+ANDS_BENCHMARK_SAVE=1. They're scaled by a fixed pure python loop timed at the
+start of the run, and a benchmark with a baseline fails if it's more than the
+threshold slower than it. No baselines are committed, as they only mean
+something on the machine they were recorded on.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+import ckan.plugins
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckan.tests import helpers
+from ckan.tests.helpers import FunctionalTestBase, _get_test_app
+from lxml import etree
+from lxml.builder import ElementMaker
+from mock import patch
+from nose.tools import assert_equal
+
+import ckanext.ands.helpers
+from ckanext.ands.auth import package_delete
+from ckanext.ands.controller import build_xml
+from ckanext.ands.datacite import DataCiteSerializer
+from ckanext.ands.helpers import can_request_doi, package_get_year, package_has_doi
+from ckanext.ands.model import DoiRequest, doi_request_exists, package_doi
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+
+settings = {
+    'ckanext.ands.publisher': 'Test Publisher',
+    'ckanext.ands.client_id': '10',
+}
+
+dataset_dict = {
+    'author': 'An Author',
+    'title': 'A dataset to do things with',
+    'metadata_created': datetime(2016, 5, 4, 3, 2, 1),
+    'notes': 'Some notes about this dataset',
+}
+
+
+def records_per_second(func, *args, **kwargs):
+    number = kwargs.pop('number', 2000)
+    start = time.time()
+    for _ in xrange(number):
+        func(*args)
+    return number / (time.time() - start)
+
+
+_calibration = []
+_results = {}
+
+
+def calibration_rate():
+    """ Loops per second of a fixed workload, to scale results by this machine's speed """
+    if not _calibration:
+        _calibration.append(records_per_second(lambda: sorted(str(i) for i in xrange(200)), number=5000))
+    return _calibration[0]
+
+
+def load_baselines():
+    try:
+        with open(BASELINES_FILE) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def get_threshold():
+    return float(os.environ.get('ANDS_BENCHMARK_THRESHOLD', 0.25))
+
+
+def report(name, rate):
+    """
+    Print a result and fail if it has regressed past the threshold
+    @param rate: records per second
+    """
+    relative = rate / calibration_rate()
+    _results[name] = relative
+    baseline = load_baselines().get(name)
+    if baseline is None:
+        print('{}: {:.0f} records/second (no baseline)'.format(name, rate))
+        return
+    change = relative / baseline - 1
+    print('{}: {:.0f} records/second ({:+.0%} on baseline)'.format(name, rate, change))
+    if not os.environ.get('ANDS_BENCHMARK_SAVE'):
+        assert change >= -get_threshold(), \
+            '{} is {:.0%} slower than its baseline'.format(name, -change)
+
+
+def assert_faster(name, rate, slower_name, slower_rate, factor=1.0):
+    """
+    Fail unless a path is at least factor times as fast as its slower alternative,
+    less ANDS_BENCHMARK_THRESHOLD. Both are timed in the same run.
+    @param rate: records per second
+    """
+    ratio = rate / slower_rate
+    print('{}: {:.1f}x {}'.format(name, ratio, slower_name))
+    assert ratio >= factor * (1 - get_threshold()), \
+        '{} is only {:.1f}x as fast as {}, expected {:.1f}x'.format(name, ratio, slower_name, factor)
+
+
+def teardown_module():
+    if os.environ.get('ANDS_BENCHMARK_SAVE') and _results:
+        baselines = load_baselines()
+        baselines.update((name, round(value, 6)) for name, value in _results.items())
+        with open(BASELINES_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+
+def parsed_year(pkg_dict):
+    """ package_get_year without its fast paths or cache, for comparison """
+    import dateutil.parser
+    return dateutil.parser.parse(pkg_dict['metadata_created']).year
+
+
+def parse_rate():
+    return records_per_second(parsed_year, {'metadata_created': '2016-05-04T03:02:01.123456'})
+
+
+def legacy_build_xml(dataset, config):
+    """ build_xml as it was before the serializer, for comparison """
+    namespaces = {
+        'xsi': "http://www.w3.org/2001/XMLSchema-instance",
+        None: "http://datacite.org/schema/kernel-3",
+    }
+    Root = ElementMaker(nsmap=namespaces)
+    E = ElementMaker()
+    xml = Root.resource(
+        E.identifier(config.get('ckanext.ands.doi_prefix', '10.5072/') + config['ckanext.ands.client_id'],
+                     identifierType="DOI"),
+        E.creators(E.creator(E.creatorName(dataset['author']))),
+        E.titles(E.title(dataset['title'])),
+        E.publisher(config['ckanext.ands.publisher']),
+        E.publicationYear("{}".format(dataset['metadata_created'].year)),
+        E.language('en'),
+        E.resourceType('gDMCP Dataset', resourceTypeGeneral="Dataset"),
+        E.descriptions(E.description(dataset['notes'], descriptionType="Abstract")),
+    )
+    xml.attrib[etree.QName(namespaces['xsi'], 'schemaLocation')] = \
+        "http://datacite.org/schema/kernel-3 http://schema.datacite.org/meta/kernel-3/metadata.xsd"
+    return etree.tostring(xml, pretty_print=True)
+
+
+class TestDataCiteBenchmark(object):
+    def test_serialize_matches_legacy(self):
+        serializer = DataCiteSerializer.from_config(settings)
+        assert_equal(serializer.serialize(dict(dataset_dict)), legacy_build_xml(dataset_dict, settings))
+
+    def test_serialize(self):
+        serializer = DataCiteSerializer.from_config(settings)
+        legacy_rate = records_per_second(legacy_build_xml, dataset_dict, settings)
+        rate = records_per_second(serializer.serialize, dataset_dict)
+        report('legacy build_xml', legacy_rate)
+        report('DataCiteSerializer.serialize', rate)
+        assert_faster('DataCiteSerializer.serialize', rate, 'legacy build_xml', legacy_rate)
+
+    def test_build_xml(self):
+        with patch.dict('pylons.config', settings):
+            rate = records_per_second(build_xml, dataset_dict)
+        legacy_rate = records_per_second(legacy_build_xml, dataset_dict, settings)
+        report('build_xml', rate)
+        assert_faster('build_xml', rate, 'legacy build_xml', legacy_rate)
+
+    def test_write(self):
+        serializer = DataCiteSerializer.from_config(settings)
+        number = 2000
+        out = BytesIO()
+        start = time.time()
+        written = serializer.write(out, (dataset_dict for _ in xrange(number)))
+        report('DataCiteSerializer.write', number / (time.time() - start))
+
+        assert_equal(written, number)
+        resources = etree.fromstring(out.getvalue())
+        assert_equal(len(resources), number)
+
+
+class TestPackageGetYearBenchmark(object):
+    def test_datetime(self):
+        pkg_dict = {'metadata_created': datetime(2016, 5, 4, 3, 2, 1)}
+        assert_equal(package_get_year(pkg_dict), 2016)
+        rate = records_per_second(package_get_year, pkg_dict, number=100000)
+        report('package_get_year datetime', rate)
+        assert_faster('package_get_year datetime', rate, 'dateutil', parse_rate(), factor=10)
+
+    def test_iso_string(self):
+        pkg_dict = {'metadata_created': '2016-05-04T03:02:01.123456'}
+        assert_equal(package_get_year(pkg_dict), 2016)
+        # The dict isn't touched
+        assert_equal(pkg_dict, {'metadata_created': '2016-05-04T03:02:01.123456'})
+        rate = records_per_second(package_get_year, pkg_dict, number=100000)
+        report('package_get_year ISO string', rate)
+        assert_faster('package_get_year ISO string', rate, 'dateutil', parse_rate(), factor=10)
+
+    def test_other_string(self):
+        pkg_dict = {'metadata_created': 'May 4 2016 03:02:01'}
+        assert_equal(package_get_year(pkg_dict), 2016)
+        rate = records_per_second(package_get_year, pkg_dict, number=100000)
+        report('package_get_year other string', rate)
+        # Parsed once, then cached
+        assert_faster('package_get_year other string', rate, 'dateutil', parse_rate(), factor=10)
+
+
+class TestPackageDoiBenchmark(object):
+    @classmethod
+    def setup_class(cls):
+        helpers.reset_db()
+        ckan.plugins.load('ands')
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.plugins.unload('ands')
+
+    def test_package_doi(self):
+        dataset = factories.Dataset(author='test author', doi_id='testdoi',
+                                    resources=[{'url': 'http://example.com/{}'.format(i)} for i in xrange(50)])
+        package_show = toolkit.get_action('package_show')
+
+        assert_equal(package_doi(dataset['name']), package_show({'ignore_auth': True}, {'id': dataset['name']})['doi_id'])
+        show_rate = records_per_second(lambda: package_show({'ignore_auth': True}, {'id': dataset['name']}),
+                                       number=50)
+        rate = records_per_second(package_doi, dataset['name'], number=500)
+        report('package_show, 50 resources', show_rate)
+        report('package_doi, 50 resources', rate)
+        assert_faster('package_doi', rate, 'package_show', show_rate, factor=2)
+
+    def test_package_has_doi(self):
+        dataset = factories.Dataset(author='test author', doi_id='10.5072/has_doi')
+
+        with patch.object(ckanext.ands.helpers.toolkit, 'c', FakeContext(None)):
+            assert package_has_doi(dataset['id'])
+            cached_rate = records_per_second(package_has_doi, dataset['id'], number=10000)
+
+        def new_request():
+            with patch.object(ckanext.ands.helpers.toolkit, 'c', FakeContext(None)):
+                package_has_doi(dataset['id'])
+        rate = records_per_second(new_request, number=500)
+
+        report('package_has_doi, same request', cached_rate)
+        report('package_has_doi, new request', rate)
+        assert_faster('package_has_doi, same request', cached_rate, 'new request', rate, factor=2)
+
+
+class TestPluginImportBenchmark(object):
+    def test_plugin_import(self):
+        # A fresh interpreter, so nothing this test run has imported counts
+        script = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "import ckanext.ands.plugin\n"
+            "print(time.time() - start)\n"
+            "print(' '.join(m for m in ('ckanext.ands.controller', 'ckanext.ands.client')"
+            " if m in sys.modules))\n"
+        )
+        output = subprocess.check_output([sys.executable, '-c', script]).splitlines()
+        print('import ckanext.ands.plugin: {:.3f}s'.format(float(output[0])))
+
+        # Loaded on first use instead
+        assert_equal(output[1:], [''])
+
+
+class FakeContext(object):
+    """ Stands in for pylons.c outside of a request """
+    def __init__(self, userobj):
+        self.userobj = userobj
+
+
+class PluginBenchmark(FunctionalTestBase):
+    @classmethod
+    def setup_class(cls):
+        super(PluginBenchmark, cls).setup_class()
+        ckan.plugins.load('ands')
+
+    @classmethod
+    def teardown_class(cls):
+        ckan.plugins.unload('ands')
+
+
+def package_show_rate(dataset):
+    package_show = toolkit.get_action('package_show')
+    return records_per_second(lambda: package_show({'ignore_auth': True}, {'id': dataset['id']}), number=100)
+
+
+class TestAuthBenchmark(PluginBenchmark):
+    def test_can_request_doi(self):
+        user = factories.User()
+        org = factories.Organization(users=[{'name': user['name'], 'capacity': 'member'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+        userobj = model.User.get(user['id'])
+
+        with patch.object(ckanext.ands.helpers.toolkit, 'c', FakeContext(userobj)):
+            assert can_request_doi(dataset)
+            # Cached for the rest of the request after the first check
+            cached_rate = records_per_second(can_request_doi, dataset, number=10000)
+
+        def new_request():
+            with patch.object(ckanext.ands.helpers.toolkit, 'c', FakeContext(userobj)):
+                can_request_doi(dataset)
+        rate = records_per_second(new_request, number=200)
+
+        report('can_request_doi, same request', cached_rate)
+        report('can_request_doi, new request', rate)
+        assert_faster('can_request_doi, same request', cached_rate, 'new request', rate, factor=2)
+
+    def test_package_delete(self):
+        user = factories.User()
+        dataset = factories.Dataset(user=user, doi_id='10.5072/benchmark')
+        context = {'model': model, 'user': user['name'], 'auth_user_obj': model.User.get(user['id'])}
+
+        assert_equal(package_delete(dict(context), {'id': dataset['id']})['success'], False)
+        rate = records_per_second(lambda: package_delete(dict(context), {'id': dataset['id']}), number=500)
+        report('package_delete auth', rate)
+        # It looks up the DOI rather than loading the whole dataset
+        assert_faster('package_delete auth', rate, 'package_show', package_show_rate(dataset))
+
+    def test_doi_request_exists(self):
+        user = factories.User()
+        dataset = factories.Dataset()
+        model.Session.add(DoiRequest(package_id=dataset['id'], user_id=user['id']))
+        model.Session.commit()
+
+        assert doi_request_exists(dataset['id'], user['id'])
+        rate = records_per_second(doi_request_exists, dataset['id'], user['id'], number=500)
+        report('doi_form duplicate request check', rate)
+        # Made before loading the dataset, instead of after
+        assert_faster('doi_form duplicate request check', rate, 'package_show', package_show_rate(dataset),
+                      factor=2)
+
+
+class TestCitationBenchmark(PluginBenchmark):
+    def test_citation(self):
+        dataset = factories.Dataset(author='test author', doi_id='10.5072/citation')
+        app = _get_test_app()
+        url = '/dataset/{}'.format(dataset['name'])
+        app.get(url).mustcontain('10.5072/citation')
+
+        cached_rate = records_per_second(lambda: app.get(url), number=50)
+
+        def uncached():
+            ckanext.ands.helpers._citation_cache.clear()
+            app.get(url)
+        rate = records_per_second(uncached, number=50)
+
+        report('dataset page, citation cached', cached_rate)
+        report('dataset page, citation rendered', rate)
+        # The rest of the page dominates, the cache only has to not cost anything
+        assert_faster('dataset page, citation cached', cached_rate, 'citation rendered', rate)
@@ -1,22 +1,37 @@
 """Tests for plugin.py."""
 import json
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 import ckan
 import requests
 from ckan import model
 from ckan.lib.helpers import url_for
+from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests import helpers
 from ckan.tests.helpers import FunctionalTestBase, _get_test_app
+from lxml import etree
 from mock import Mock
 from mock import call
 from mock import patch
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from pylons import config
+from sqlalchemy import event
 
+import ckanext.ands.batch
 import ckanext.ands.controller
-from ckanext.ands.controller import build_xml, post_doi_request, doi_request_fields
+import ckanext.ands.datacite
+import ckanext.ands.helpers
+import ckanext.ands.jobs
+import ckanext.ands.mail
+from ckanext.ands import client, metrics, migration
+from ckanext.ands.jobs import work
+from ckanext.ands.model import (
+    DoiMintJob, DoiRequest, MintAttempt, enqueue_mint_job, rate_limit_table, requestor_contacts,
+    take_rate_limit_token)
+from ckanext.ands.controller import MintError, MintResult, build_xml, post_doi_request, doi_request_fields
+from ckanext.ands.fake_ands import FakeAndsApp
 
 test_dataset_dict = {
     'author': 'An Author',
@@ -49,16 +64,150 @@ class TestAndsController(FunctionalTestBase):
     def test_post_doi_request(self):
         test_dataset_url = 'http://blah.com'
         contents = ''
-        with patch.object(requests, 'post') as mock_post:
+        with patch.object(requests.Session, 'post') as mock_post:
             post_doi_request(test_dataset_url, contents)
 
         expected = [
             call('https://services.ands.org.au/doi/1.1/mint.json/?app_id=atestdoikey&url={}&debug=False'.format(
                 test_dataset_url),
-                data={'xml': contents, 'shared_secret': 'atestdoisecret'})]
+                data={'xml': contents, 'shared_secret': 'atestdoisecret'},
+                timeout=(5.0, 30.0))]
 
         assert_equal(mock_post.mock_calls, expected)
 
+    def test_post_doi_request_metrics(self):
+        sink = metrics.MemorySink()
+        metrics.set_sink(sink)
+        try:
+            with patch.object(requests.Session, 'post'):
+                post_doi_request('http://blah.com', '')
+        finally:
+            metrics.set_sink(metrics.MemorySink())
+
+        assert_equal(sink.counters['ands.requests'], 1)
+        assert_equal(len(sink.timings['ands.request']), 1)
+
+    def test_dataset_doi_admin_metrics(self):
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
+
+        sink = metrics.MemorySink()
+        metrics.set_sink(sink)
+        try:
+            with patch.object(requests.Session, 'post', return_value=mock_response):
+                self.app.post(url, {'xml': 'test'}, extra_environ=env)
+        finally:
+            metrics.set_sink(metrics.MemorySink())
+
+        assert_equal(sink.counters['ands.mint.response.MT001'], 1)
+        assert_equal(sink.counters['ands.mint.success'], 1)
+        for name in ('ands.mint.total', 'ands.mint.post', 'ands.mint.save', 'ands.email_requestors'):
+            assert_equal(len(sink.timings[name]), 1, name)
+
+    def test_response_code_metric_missing_code(self):
+        sink = metrics.MemorySink()
+        metrics.set_sink(sink)
+        try:
+            with patch.object(ckanext.ands.controller, '_post_to_ands',
+                              return_value=Mock(content=json.dumps(dict(response=dict(message='oops'))))):
+                ckanext.ands.controller.request_mint('http://blah.com', 'test')
+        finally:
+            metrics.set_sink(metrics.MemorySink())
+
+        assert_equal(sink.counters['ands.mint.response.unknown'], 1)
+        assert 'ands.mint.response.None' not in sink.counters
+
+    def test_statsd_sink(self):
+        sink = metrics.StatsdSink(prefix='test.')
+        with patch.object(sink, '_socket') as mock_socket:
+            sink.timing('ands.request', 0.25)
+            sink.incr('ands.errors')
+
+        assert_equal(mock_socket.sendto.mock_calls, [
+            call('test.ands.request:250.000|ms', ('localhost', 8125)),
+            call('test.ands.errors:1|c', ('localhost', 8125)),
+        ])
+
+    def test_client_session_reused(self):
+        client.close()
+        session = client.get_session()
+        assert client.get_session() is session
+        client.close()
+        assert client.get_session() is not session
+
+    def test_circuit_breaker(self):
+        breaker = client.CircuitBreaker(threshold=0.5, window=4, min_calls=4, cooldown=60)
+        for success in (True, False, True, False):
+            breaker.before_call()
+            breaker.record(success)
+        assert_raises(client.CircuitOpen, breaker.before_call)
+        assert breaker.retry_after() > 0
+
+        # After the cooldown a single trial call is let through
+        breaker.opened -= 60
+        breaker.before_call()
+        assert_raises(client.CircuitOpen, breaker.before_call)
+        breaker.record(True)
+        breaker.before_call()
+        assert_equal(breaker.retry_after(), 0)
+
+    def test_rate_limit_token_bucket(self):
+        with model.meta.engine.begin() as connection:
+            connection.execute(rate_limit_table.delete())
+        # The missing row is added, full
+        assert_equal([take_rate_limit_token(0.001, 2) for _ in xrange(3)], [True, True, False])
+        with model.meta.engine.begin() as connection:
+            connection.execute(rate_limit_table.update().values(updated=datetime.now() - timedelta(days=1)))
+        assert take_rate_limit_token(0.001, 2)
+
+    def test_rate_limited_trial_call(self):
+        breaker = client.get_breaker()
+        breaker.reset()
+        settings = {'ckanext.ands.rate_limit': '0.001', 'ckanext.ands.rate_limit_burst': '1',
+                    'ckanext.ands.rate_limit_wait': '0'}
+        try:
+            breaker.opened = time.time() - breaker.cooldown
+            with patch.dict(config, settings), patch.object(requests.Session, 'post') as mock_post:
+                while take_rate_limit_token(0.001, 1):
+                    pass
+                assert_raises(client.RateLimited, client.post, 'http://ands.example.com/')
+            assert_equal(mock_post.mock_calls, [])
+            # Still waiting on a trial, the next caller gets to make it
+            assert breaker.opened is not None
+            breaker.before_call()
+        finally:
+            breaker.reset()
+
+        with patch.object(ckanext.ands.controller, '_post_to_ands', side_effect=client.RateLimited('limited')):
+            assert_raises(ckanext.ands.controller.AndsUnavailable, ckanext.ands.controller.request_mint,
+                          'http://blah.com', 'test')
+
+    def test_circuit_breaker_fails_fast(self):
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+
+        client.get_breaker().reset()
+        try:
+            with patch.object(requests.Session, 'post', side_effect=requests.ConnectionError('down')) as mock_post:
+                for i in xrange(5):
+                    self.app.post(url, {'xml': 'test'}, extra_environ=env)
+                response = self.app.post(url, {'xml': 'test'}, extra_environ=env)
+            # Not called once the breaker opened
+            assert_equal(len(mock_post.mock_calls), 5)
+            response.follow(extra_environ=env).mustcontain('responding at the moment, try again in')
+            self.app.get(url, extra_environ=env).mustcontain('Recent requests to ANDS have failed')
+        finally:
+            client.get_breaker().reset()
+
     def test_dataset_has_doi_request_no_user(self):
         model.repo.rebuild_db()
         dataset = factories.Dataset(author='test author')
@@ -128,7 +277,7 @@ class TestAndsController(FunctionalTestBase):
             id=dataset['name'])
         mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
         mock_post = Mock(return_value=mock_response)
-        with patch.object(requests, 'post', new=mock_post):
+        with patch.object(requests.Session, 'post', new=mock_post):
             response = self.app.post(url, {'xml': 'test'}, extra_environ=env)
 
         # Don't bother checking the mocks, other tests do this
@@ -152,9 +301,9 @@ class TestAndsController(FunctionalTestBase):
 
         response = self.app.get(url, extra_environ=env)
         form = response.forms['dataset-doi']
-        assert_equal(sorted(form.fields.keys()), ['save', 'xml'])
+        assert_equal(sorted(form.fields.keys()), ['idempotency_key', 'save', 'xml'])
 
-        with patch.object(requests, 'post', new=mock_post):
+        with patch.object(requests.Session, 'post', new=mock_post):
             response = form.submit('submit', extra_environ=env)
 
         # Don't bother checking the mocks, other tests do this
@@ -166,6 +315,79 @@ class TestAndsController(FunctionalTestBase):
         response.mustcontain('Cite this as')
 
 
+    def test_dataset_doi_admin_async(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
+        mock_post = Mock(return_value=mock_response)
+
+        with patch.dict(config, {'ckanext.ands.async_mint': 'true'}):
+            with patch.object(requests.Session, 'post', new=mock_post):
+                response = self.app.post(url, {'xml': 'test'}, extra_environ=env)
+            assert_equal(mock_post.mock_calls, [])
+
+            response = response.follow(extra_environ=env)
+            response.mustcontain('DOI pending')
+            response.mustcontain(no='Approve DOI')
+
+            with patch.object(requests.Session, 'post', new=mock_post):
+                work({'user': sysadmin['name']}, once=True)
+            assert_equal(len(mock_post.mock_calls), 1)
+
+        response = self.app.get(url_for(
+            controller='package', action='read',
+            id=dataset['name']), extra_environ=env)
+        response.mustcontain(no='DOI pending')
+        response.mustcontain('Cite this as')
+
+    def test_mint_job_done_when_mail_fails(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        requestor = factories.User()
+        model.Session.add(DoiRequest(package_id=dataset['id'], user_id=requestor['id']))
+        model.Session.commit()
+        enqueue_mint_job(dataset['id'], 'http://test.ckan.net/dataset/{}'.format(dataset['name']), 'test')
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
+
+        with patch.object(requests.Session, 'post', return_value=mock_response), \
+                patch.object(ckanext.ands.controller, 'mail_recipient', side_effect=Exception('SMTP down')) as mock_mail:
+            work({'user': sysadmin['name']}, once=True)
+
+        assert_equal(len(mock_mail.mock_calls), 1)
+        job = model.Session.query(DoiMintJob).filter_by(package_id=dataset['id']).one()
+        assert_equal((job.status, job.doi, job.last_error), (DoiMintJob.DONE, 'testdoi', None))
+        assert_equal(helpers.call_action('package_show', id=dataset['id'])['doi_id'], 'testdoi')
+
+    def test_mint_job_concurrent_approval(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        enqueue_mint_job(dataset['id'], 'http://test.ckan.net/dataset/{}'.format(dataset['name']), 'test')
+        real_request_mint = ckanext.ands.jobs.request_mint
+
+        def request_mint(*args):
+            # Approved from the dataset page while the job was minting
+            helpers.call_action('package_patch', id=dataset['id'], doi_id='10.5072/approved')
+            return real_request_mint(*args)
+
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/job'))))
+        with patch.object(requests.Session, 'post', return_value=mock_response), \
+                patch.object(ckanext.ands.jobs, 'request_mint', side_effect=request_mint):
+            work({'user': sysadmin['name']}, once=True)
+
+        job = model.Session.query(DoiMintJob).filter_by(package_id=dataset['id']).one()
+        assert_equal((job.status, job.doi), (DoiMintJob.DONE, '10.5072/approved'))
+        assert_equal(helpers.call_action('package_show', id=dataset['id'])['doi_id'], '10.5072/approved')
+
+        # Nothing more is queued for it
+        assert_equal(enqueue_mint_job(dataset['id'], 'http://test.ckan.net/dataset/x', 'test'), None)
+
     def test_dataset_doi_admin_non_sysadmin(self):
         model.repo.rebuild_db()
         dataset = factories.Dataset(author='test author')
@@ -246,7 +468,7 @@ class TestAndsController(FunctionalTestBase):
             id=dataset['name'])
         mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
         mock_post = Mock(return_value=mock_response)
-        with patch.object(requests, 'post', new=mock_post):
+        with patch.object(requests.Session, 'post', new=mock_post):
             with patch.object(ckanext.ands.controller, 'mail_recipient') as mock_mail:
                 response = self.app.post(url, {'xml': 'test'}, extra_environ=env)
 
@@ -288,6 +510,64 @@ class TestAndsController(FunctionalTestBase):
         response.mustcontain(
             "You&#39;ve already requested a DOI for this dataset. You&#39;ll be emailed if it is approved.")
 
+    def test_repeated_request_not_emailed(self):
+        dataset = factories.Dataset(author='test author')
+        user = factories.User()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi', id=dataset['name'])
+
+        with patch.object(ckanext.ands.controller, 'mail_recipient') as mock_mail:
+            self.app.post(url, {'paper_title': 'test'}, extra_environ=env)
+            # Sent again, say from a second tab
+            response = self.app.post(url, {'paper_title': 'test'}, extra_environ=env)
+
+        assert_equal(len(mock_mail.mock_calls), 1)
+        assert_equal(model.Session.query(DoiRequest).filter_by(package_id=dataset['id']).count(), 1)
+        response.follow(extra_environ=env).mustcontain("already requested a DOI for this dataset")
+
+    def test_request_only_sets_form_fields(self):
+        dataset = factories.Dataset(author='test author')
+        user = factories.User()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi', id=dataset['name'])
+
+        with patch.object(ckanext.ands.controller, 'mail_recipient'):
+            self.app.post(url, {'paper_title': 'test', 'status': 'approved', 'doi': '10.5072/forged',
+                                'resolved': '2016-01-01'}, extra_environ=env)
+
+        doi_request = model.Session.query(DoiRequest).filter_by(package_id=dataset['id']).one()
+        assert_equal((doi_request.paper_title, doi_request.status, doi_request.doi, doi_request.resolved),
+                     (u'test', DoiRequest.PENDING, None, None))
+
+    def test_request_unreadable_dataset(self):
+        org = factories.Organization()
+        dataset = factories.Dataset(author='test author', owner_org=org['id'], private=True)
+        user = factories.User()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi', id=dataset['name'])
+
+        with patch.object(ckanext.ands.controller, 'mail_recipient') as mock_mail:
+            self.app.post(url, {'paper_title': 'test'}, extra_environ=env, status=401)
+
+        assert_equal(mock_mail.mock_calls, [])
+        assert_equal(model.Session.query(DoiRequest).filter_by(package_id=dataset['id']).count(), 0)
+
+    def test_search_has_doi(self):
+        model.repo.rebuild_db()
+        with_doi = factories.Dataset(author='test author', doi_id='10.5072/search')
+        factories.Dataset(author='test author')
+
+        result = helpers.call_action('package_search', fq='has_doi:true', **{'facet.field': ['has_doi']})
+        assert_equal([d['id'] for d in result['results']], [with_doi['id']])
+        assert_equal(result['results'][0]['doi_id'], '10.5072/search')
+        assert_equal(result['facets']['has_doi'], {'true': 1})
+
+        result = helpers.call_action('package_search', fq='doi_id:"10.5072/search"')
+        assert_equal(result['count'], 1)
+
     def test_user_cannot_delete_doi(self):
         model.repo.rebuild_db()
         user = factories.User()
@@ -385,3 +665,504 @@ class TestAndsController(FunctionalTestBase):
         response.mustcontain("Cannot add a DOI to a private dataset")
         response.mustcontain(no='Approve DOI')
         response.mustcontain(no='Request DOI')
+
+    def test_doi_mint_batch(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author')
+        existing = factories.Dataset(author='test author', doi_id='existingdoi')
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='testdoi'))))
+        mock_post = Mock(return_value=mock_response)
+
+        with patch.object(requests.Session, 'post', new=mock_post):
+            results = helpers.call_action(
+                'doi_mint_batch', context={'user': sysadmin['name']},
+                ids=[dataset['name'], existing['name'], 'missing'])
+
+        assert_equal(len(mock_post.mock_calls), 1)
+        assert_equal([(r['id'], r['success'], r['doi']) for r in results], [
+            (dataset['name'], True, 'testdoi'),
+            (existing['name'], False, 'existingdoi'),
+            ('missing', False, None),
+        ])
+        assert_equal(helpers.call_action('package_show', id=dataset['id'])['doi_id'], 'testdoi')
+
+    def test_doi_mint_batch_failures_per_dataset(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        emailed = factories.Dataset(author='test author')
+        failing = factories.Dataset(author='test author')
+        last = factories.Dataset(author='test author')
+        model.Session.add(DoiRequest(package_id=emailed['id'], user_id=factories.User()['id']))
+        model.Session.commit()
+        responses = [Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi=doi))))
+                     for doi in ('doi1', 'doi2', 'doi3')]
+
+        real_save_doi = ckanext.ands.batch.save_doi
+
+        def save_doi(context, dataset, doi, dataset_url=None):
+            if dataset['id'] == failing['id']:
+                raise Exception('Database went away')
+            return real_save_doi(context, dataset, doi, dataset_url)
+
+        with patch.object(requests.Session, 'post', side_effect=responses), \
+                patch.object(ckanext.ands.batch, 'save_doi', side_effect=save_doi), \
+                patch.object(ckanext.ands.controller, 'mail_recipient', side_effect=Exception('SMTP down')):
+            results = helpers.call_action(
+                'doi_mint_batch', context={'user': sysadmin['name']}, workers=1,
+                ids=[emailed['name'], failing['name'], last['name']])
+
+        assert_equal([(r['success'], r['doi']) for r in results],
+                     [(True, 'doi1'), (False, 'doi2'), (True, 'doi3')])
+        assert_equal(helpers.call_action('package_show', id=emailed['id'])['doi_id'], 'doi1')
+        assert_equal(helpers.call_action('package_show', id=last['id'])['doi_id'], 'doi3')
+        # Minted but not saved, still logged
+        attempt = model.Session.query(MintAttempt).filter_by(package_id=failing['id']).one()
+        assert_equal((attempt.success, attempt.doi), (True, 'doi2'))
+
+    def test_doi_mint_batch_concurrent_approval(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author')
+        real_request_mint = ckanext.ands.batch.request_mint
+
+        def request_mint(*args):
+            # Approved from the dataset page while the batch was minting
+            helpers.call_action('package_patch', id=dataset['id'], doi_id='10.5072/approved')
+            model.Session.remove()
+            return real_request_mint(*args)
+
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/batch'))))
+        with patch.object(requests.Session, 'post', return_value=mock_response), \
+                patch.object(ckanext.ands.batch, 'request_mint', side_effect=request_mint):
+            results = helpers.call_action(
+                'doi_mint_batch', context={'user': sysadmin['name']}, ids=[dataset['name']])
+
+        assert_equal([(r['success'], r['doi']) for r in results], [(False, '10.5072/approved')])
+        assert_equal(helpers.call_action('package_show', id=dataset['id'])['doi_id'], '10.5072/approved')
+
+    def test_sync_on_update(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author')
+        minted = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/sync'))))
+        updated = Mock(content=json.dumps(dict(response=dict(responsecode='MT002', doi='10.5072/sync'))))
+
+        with patch.dict(config, {'ckanext.ands.sync_on_update': 'true'}):
+            with patch.object(requests.Session, 'post', return_value=minted) as mock_post:
+                helpers.call_action('doi_mint_batch', context={'user': sysadmin['name']}, ids=[dataset['id']])
+            # Minting doesn't send the metadata again
+            assert_equal(len(mock_post.mock_calls), 1)
+
+            with patch.object(requests.Session, 'post', return_value=updated) as mock_post:
+                # Not in the XML, nothing to send
+                helpers.call_action('package_patch', id=dataset['id'], url='http://example.com')
+                assert_equal(len(mock_post.mock_calls), 0)
+
+                helpers.call_action('package_patch', id=dataset['id'], title='A new title')
+                assert_equal(len(mock_post.mock_calls), 1)
+                assert '/update.json/?app_id=atestdoikey&doi=10.5072/sync&' in mock_post.call_args[0][0]
+                assert '<title>A new title</title>' in mock_post.call_args[1]['data']['xml']
+
+                # Sent already
+                helpers.call_action('package_patch', id=dataset['id'], title='A new title')
+                assert_equal(len(mock_post.mock_calls), 1)
+
+    def test_resync(self):
+        from ckanext.ands.model import set_sent_xml
+        from ckanext.ands.sync import resync
+
+        model.repo.rebuild_db()
+        changed = factories.Dataset(author='test author', doi_id='10.5072/changed')
+        factories.Dataset(author='test author', doi_id='10.5072/unchanged')
+        factories.Dataset(author='test author')
+        updated = Mock(content=json.dumps(dict(response=dict(responsecode='MT002'))))
+        # Neither has been sent yet
+        with patch.object(requests.Session, 'post', return_value=updated) as mock_post:
+            assert_equal([r['status'] for r in resync()], ['updated', 'updated'])
+        assert_equal(len(mock_post.mock_calls), 2)
+        set_sent_xml(changed['id'], u'<resource/>', u'stale', None)
+        model.Session.commit()
+
+        with patch.object(requests.Session, 'post', return_value=updated) as mock_post:
+            results = sorted((r['doi'], r['status']) for r in resync())
+
+        assert_equal(results, [('10.5072/changed', 'updated'), ('10.5072/unchanged', 'unchanged')])
+        assert_equal(len(mock_post.mock_calls), 1)
+
+    def test_sent_xml(self):
+        from ckanext.ands.model import PackageDoi
+
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        mock_response = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/sent'))))
+
+        with patch('ckanext.ands.controller.build_xml', wraps=build_xml) as mock_build:
+            form = self.app.get(url, extra_environ=env)
+            self.app.get(url, extra_environ=env)
+        # Built once for the unchanged dataset
+        assert_equal(len(mock_build.mock_calls), 1)
+
+        with patch.object(requests.Session, 'post', return_value=mock_response):
+            self.app.post(url, {'xml': form.forms['dataset-doi']['xml'].value}, extra_environ=env)
+
+        package_doi = model.Session.query(PackageDoi).get(dataset['id'])
+        assert '<identifier identifierType="DOI">10.5072/sent</identifier>' in package_doi.xml
+        assert_equal(package_doi.xml_hash, ckanext.ands.datacite.xml_hash(package_doi.xml))
+        assert_equal(package_doi.xml_modified, model.Package.get(dataset['id']).metadata_modified)
+
+    def test_mint_result(self):
+        resp = Mock(content=json.dumps(dict(response=dict(
+            responsecode='MT010', type='failure', message='Bad things', verbosemessage='Worse things'))))
+        result = MintResult.from_response(resp, 0.5)
+        assert_equal((result.responsecode, result.minted, result.elapsed), ('MT010', False, 0.5))
+        assert_equal(result.error_message(), 'MT010 - failure. Worse things. Bad things')
+        assert_raises(AttributeError, setattr, result, 'other', 1)
+
+        assert_raises(MintError, MintResult.from_response, Mock(content='<html>'))
+        assert_raises(MintError, MintResult.from_response, Mock(content='{}'))
+
+    def test_mint_attempts_logged(self):
+        from ckanext.ands.model import MintAttempt, mint_attempt_counts
+
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        failed = Mock(content=json.dumps(dict(response=dict(responsecode='MT010', type='failure'))))
+        minted = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/logged'))))
+
+        for resp in (Mock(content='not json'), failed, minted):
+            with patch.object(requests.Session, 'post', return_value=resp):
+                self.app.post(url, {'xml': 'test'}, extra_environ=env)
+
+        attempts = model.Session.query(MintAttempt).filter_by(package_id=dataset['id']).order_by(MintAttempt.id)
+        assert_equal([(a.responsecode, a.success, a.doi) for a in attempts],
+                     [(None, False, None), ('MT010', False, None), ('MT001', True, '10.5072/logged')])
+        assert_equal(mint_attempt_counts(operation=MintAttempt.MINT), {None: 1, 'MT010': 1, 'MT001': 1})
+
+    def test_mint_attempt_non_ascii_error(self):
+        dataset = factories.Dataset(author='test author')
+        error = MintError('Invalid response from DOI server: caf\xc3\xa9 \xff')
+        ckanext.ands.controller.log_attempt(dataset['id'], MintAttempt.MINT, error=error)
+        model.Session.commit()
+
+        attempt = model.Session.query(MintAttempt).filter_by(package_id=dataset['id']).one()
+        assert_equal(attempt.message, u'Invalid response from DOI server: caf\xe9 \ufffd')
+
+    def test_non_ascii_invalid_response(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author')
+        # Cut part way through a multibyte character
+        mock_post = Mock(return_value=Mock(content='<html> ' + '\xc3\xa9' * 200))
+
+        with patch.object(requests.Session, 'post', new=mock_post):
+            results = helpers.call_action(
+                'doi_mint_batch', context={'user': sysadmin['name']}, ids=[dataset['name']])
+
+        message = results[0]['message']
+        assert isinstance(message, unicode)
+        assert message.endswith(u'<html> ' + u'\xe9' * 96 + u'\ufffd'), message
+
+    def test_mint_once(self):
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        minted = Mock(content=json.dumps(dict(response=dict(responsecode='MT001', doi='10.5072/once'))))
+        form = self.app.get(url, extra_environ=env).forms['dataset-doi']
+
+        with patch.object(requests.Session, 'post', return_value=minted) as mock_post:
+            self.app.post(url, {'xml': 'test', 'idempotency_key': form['idempotency_key'].value},
+                          extra_environ=env)
+            # Submitted again, or by someone else who had the page open
+            response = self.app.post(url, {'xml': 'test', 'idempotency_key': 'another'}, extra_environ=env)
+        assert_equal(len(mock_post.mock_calls), 1)
+        response.follow(extra_environ=env).mustcontain('This dataset already has a DOI: 10.5072/once')
+
+    def test_mint_idempotency_key(self):
+        from ckanext.ands.model import MintAttempt
+
+        dataset = factories.Dataset(author='test author')
+        sysadmin = factories.Sysadmin()
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi_admin',
+            id=dataset['name'])
+        # Minted, but the dataset was never updated
+        model.Session.add(MintAttempt(package_id=dataset['id'], operation=MintAttempt.MINT, success=True,
+                                      responsecode='MT001', doi='10.5072/earlier', idempotency_key='key'))
+        model.Session.commit()
+
+        with patch.object(requests.Session, 'post') as mock_post:
+            self.app.post(url, {'xml': 'test', 'idempotency_key': 'key'}, extra_environ=env)
+        assert_equal(len(mock_post.mock_calls), 0)
+        assert_equal(helpers.call_action('package_show', id=dataset['id'])['doi_id'], '10.5072/earlier')
+
+    def test_datacite_export(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        factories.Dataset(author='test author', title='Public one', doi_id='10.5072/one')
+        factories.Dataset(author='test author', title='Public two', doi_id='10.5072/two')
+        factories.Dataset(author='test author', title='Hidden', owner_org=org['id'], private=True)
+        url = url_for(controller='ckanext.ands.controller:DatasetDoiController', action='datacite_export')
+
+        self.app.get(url, status=401)
+
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        response = self.app.get(url, extra_environ=env)
+        resources = etree.fromstring(response.body)
+        titles = sorted(resource.findtext('{http://datacite.org/schema/kernel-3}titles/'
+                                          '{http://datacite.org/schema/kernel-3}title')
+                        for resource in resources)
+        assert_equal(titles, ['Public one', 'Public two'])
+        identifiers = sorted(resource.findtext('{http://datacite.org/schema/kernel-3}identifier')
+                             for resource in resources)
+        assert_equal(identifiers, ['10.5072/one', '10.5072/two'])
+
+    def test_datacite_export_streamed(self):
+        model.repo.rebuild_db()
+        for i in xrange(5):
+            factories.Dataset(author='test author', title='Dataset {}'.format(i))
+        factories.Dataset(author='test author', title='Control \x01 character')
+
+        chunks = ckanext.ands.controller.stream_datacite_export()
+        # As once the request is over
+        model.Session.remove()
+        resources = etree.fromstring(b''.join(chunks))
+
+        titles = sorted(resource.findtext('{http://datacite.org/schema/kernel-3}titles/'
+                                          '{http://datacite.org/schema/kernel-3}title')
+                        for resource in resources)
+        assert_equal(titles, ['Dataset {}'.format(i) for i in xrange(5)])
+
+    def test_citation_cached(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author', doi_id='testdoi')
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        url = url_for(controller='package', action='read', id=dataset['name'])
+
+        with patch.object(toolkit, 'render_snippet', wraps=toolkit.render_snippet) as mock_render:
+            self.app.get(url, extra_environ=env).mustcontain('Cite this as')
+            self.app.get(url, extra_environ=env).mustcontain('Cite this as', 'http://dx.doi.org/testdoi')
+            assert_equal(len(mock_render.mock_calls), 1)
+
+            helpers.call_action('package_patch', context={'user': sysadmin['name']},
+                                id=dataset['id'], title='A new title')
+            response = self.app.get(url, extra_environ=env)
+            assert_equal(len(mock_render.mock_calls), 2)
+        response.mustcontain('A new title')
+
+    def test_can_request_doi_for_packages(self):
+        model.repo.rebuild_db()
+        user = factories.User()
+        member_org = factories.Organization(users=[{'name': user['id'], 'capacity': 'member'}])
+        other_org = factories.Organization()
+        pkgs = [
+            factories.Dataset(author='test author', owner_org=member_org['id']),
+            factories.Dataset(author='test author', owner_org=member_org['id']),
+            factories.Dataset(author='test author', owner_org=other_org['id']),
+        ]
+
+        class Context(object):
+            userobj = model.User.get(user['id'])
+
+        mock_toolkit = Mock(c=Context())
+        with patch.object(ckanext.ands.helpers, 'toolkit', new=mock_toolkit):
+            with patch.object(ckanext.ands.helpers, 'has_user_permission_for_group_or_org') as mock_permission:
+                result = ckanext.ands.helpers.can_request_doi_for_packages(pkgs)
+                # Answered from the one membership query and remembered for the request
+                assert ckanext.ands.helpers.can_request_doi(pkgs[0])
+
+        assert_equal(mock_permission.mock_calls, [])
+        assert_equal(result, {pkgs[0]['id']: True, pkgs[1]['id']: True, pkgs[2]['id']: False})
+
+    def test_package_show_by_doi(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author', doi_id='10.5072/abc')
+        factories.Dataset(author='test author')
+
+        assert_equal(helpers.call_action('package_show_by_doi', doi='10.5072/abc')['id'], dataset['id'])
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action, 'package_show_by_doi', doi='10.5072/nothing')
+
+        # Moving the DOI keeps the lookup in step
+        helpers.call_action('package_patch', id=dataset['id'], doi_id='10.5072/def')
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action, 'package_show_by_doi', doi='10.5072/abc')
+        assert_equal(helpers.call_action('package_show_by_doi', doi='10.5072/def')['id'], dataset['id'])
+
+    def test_doi_unique(self):
+        model.repo.rebuild_db()
+        factories.Dataset(author='test author', doi_id='10.5072/abc')
+        assert_raises(toolkit.ValidationError, factories.Dataset, author='test author', doi_id='10.5072/abc')
+
+    def test_doi_redirect(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author', doi_id='10.5072/abc')
+
+        response = self.app.get('/doi/10.5072/abc')
+        assert response.headers['Location'].endswith('/dataset/{}'.format(dataset['id']))
+        self.app.get('/doi/10.5072/nothing', status=404)
+
+    def test_dataset_doi_request_async_mail(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author')
+        user = factories.User()
+        env = {'REMOTE_USER': user['name'].encode('ascii')}
+        response = self.app.get(url_for(
+            controller='ckanext.ands.controller:DatasetDoiController', action='dataset_doi',
+            id=dataset['name']), extra_environ=env)
+
+        form = response.forms['dataset-doi']
+        for field in form.fields:
+            if field != 'save':
+                form.set(field, 'test')
+
+        with patch.dict(config, {'ckanext.ands.async_mail': 'true'}):
+            with patch.object(ckanext.ands.controller, 'mail_recipient') as mock_mail:
+                form.submit('submit', extra_environ=env)
+            assert_equal(mock_mail.mock_calls, [])
+
+            mock_smtp = Mock()
+            with patch.object(ckanext.ands.mail, '_connect', return_value=mock_smtp):
+                assert_equal(ckanext.ands.mail.flush(), 1)
+                assert_equal(ckanext.ands.mail.flush(), 0)
+
+        assert_equal(len(mock_smtp.sendmail.mock_calls), 1)
+        assert_equal(mock_smtp.sendmail.mock_calls[0][1][1], [config.get('ckanext.ands.support_emails')])
+        assert_equal(len(mock_smtp.quit.mock_calls), 1)
+
+    def test_requestor_contacts_single_query(self):
+        model.repo.rebuild_db()
+        dataset = factories.Dataset(author='test author')
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        def counted_contacts():
+            del statements[:]
+            event.listen(model.meta.engine, 'before_cursor_execute', count)
+            try:
+                contacts = requestor_contacts(dataset['id'])
+            finally:
+                event.remove(model.meta.engine, 'before_cursor_execute', count)
+            return contacts, len(statements)
+
+        def add_requestor():
+            user = factories.User()
+            model.Session.add(DoiRequest(package_id=dataset['id'], user_id=user['id']))
+            model.Session.commit()
+            return user
+
+        first = add_requestor()
+        contacts, one_requestor = counted_contacts()
+        assert_equal(contacts, [(first['display_name'], first['email'])])
+
+        for _ in range(4):
+            add_requestor()
+        contacts, five_requestors = counted_contacts()
+        assert_equal(len(contacts), 5)
+        assert_equal(one_requestor, five_requestors)
+
+    def test_doi_request_list(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        org = factories.Organization()
+        in_org = factories.Dataset(author='test author', owner_org=org['id'])
+        other = factories.Dataset(author='test author')
+        for dataset in (in_org, other, in_org):
+            model.Session.add(DoiRequest(package_id=dataset['id'], user_id=factories.User()['id'],
+                                         doi_title='test'))
+            model.Session.commit()
+        context = {'user': sysadmin['name'], 'ignore_auth': False}
+
+        page = helpers.call_action('doi_request_list', context=dict(context), limit=2)
+        assert_equal(len(page['results']), 2)
+        rest = helpers.call_action('doi_request_list', context=dict(context), limit=2, marker=page['next_marker'])
+        assert_equal(len(rest['results']), 1)
+        assert_equal(rest['next_marker'], None)
+        ids = [r['id'] for r in page['results'] + rest['results']]
+        assert_equal(ids, sorted(ids, reverse=True))
+
+        page = helpers.call_action('doi_request_list', context=dict(context), owner_org=org['name'])
+        assert_equal([r['package_id'] for r in page['results']], [in_org['id'], in_org['id']])
+        assert_equal(set(r['status'] for r in page['results']), set(['pending']))
+
+        for limit in (-1, 'ten'):
+            assert_raises(toolkit.ValidationError, helpers.call_action, 'doi_request_list',
+                          context=dict(context), limit=limit)
+
+        user = factories.User()
+        assert_raises(toolkit.NotAuthorized, helpers.call_action, 'doi_request_list',
+                      context={'user': user['name'], 'ignore_auth': False})
+
+    def test_doi_request_dashboard(self):
+        model.repo.rebuild_db()
+        sysadmin = factories.Sysadmin()
+        dataset = factories.Dataset(author='test author')
+        model.Session.add(DoiRequest(package_id=dataset['id'], user_id=factories.User()['id'],
+                                     doi_title='A requested title'))
+        model.Session.commit()
+        url = url_for(controller='ckanext.ands.controller:DoiRequestAdminController', action='index')
+
+        env = {'REMOTE_USER': sysadmin['name'].encode('ascii')}
+        response = self.app.get(url, {'status': 'pending'}, extra_environ=env)
+        response.mustcontain('A requested title')
+        response = self.app.get(url, {'status': 'approved'}, extra_environ=env)
+        response.mustcontain(no='A requested title')
+
+        user = factories.User()
+        self.app.get(url, extra_environ={'REMOTE_USER': user['name'].encode('ascii')}, status=401)
+
+    def test_migration(self):
+        model.repo.rebuild_db()
+        assert_equal(migration.upgrade(), migration.LATEST_VERSION)
+        # Nothing left to do the second time
+        assert_equal(migration.upgrade(), migration.LATEST_VERSION)
+
+        dataset = factories.Dataset(author='test author', doi_id='10.5072/abc')
+        model.Session.add(DoiRequest(package_id=dataset['id'], user_id=factories.User()['id'],
+                                     status=DoiRequest.APPROVED))
+        model.Session.commit()
+
+        # Back to how version 1 left doi_requests
+        model.Session.remove()
+        with model.meta.engine.begin() as connection:
+            for column in ('updated', 'resolved', 'doi'):
+                connection.execute('ALTER TABLE doi_requests DROP COLUMN {}'.format(column))
+            connection.execute(migration.schema_version_table.update().values(version=1))
+
+        assert_equal(migration.upgrade(), migration.LATEST_VERSION)
+        assert_equal(model.Session.query(DoiRequest).one().doi, '10.5072/abc')
+
+    def test_fake_ands(self):
+        import webtest
+
+        app = webtest.TestApp(FakeAndsApp())
+        dataset = factories.Dataset(author='test author')
+        url = '/mint.json/?app_id=123&url=http://example.com/dataset'
+
+        result = app.post(url, {'xml': build_xml(dataset), 'shared_secret': 'secret'}).json['response']
+        assert_equal(result['responsecode'], 'MT001')
+        assert result['doi'].startswith('10.5072/')
+        assert_equal(result['url'], 'http://example.com/dataset')
+
+        result = app.post(url, {'xml': '<resource', 'shared_secret': 'secret'}).json['response']
+        assert_equal(result['responsecode'], 'MT006')
+        result = app.post(url, {'xml': build_xml(dataset)}).json['response']
+        assert_equal(result['responsecode'], 'MT009')
+
+        failing = webtest.TestApp(FakeAndsApp(failure_rate=1))
+        result = failing.post(url, {'xml': build_xml(dataset), 'shared_secret': 'secret'}, status=500)
+        assert_equal(result.json['response']['responsecode'], 'MT005')
@@ -0,0 +1,13 @@
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.ands.model import package_id_for_doi
+
+
+def doi_unique(value, context):
+    ''' A DOI can only belong to one dataset '''
+    if value:
+        owner = package_id_for_doi(value)
+        package = context.get('package')
+        if owner is not None and (package is None or owner != package.id):
+            raise toolkit.Invalid('This DOI already belongs to another dataset')
+    return value
@@ -80,6 +80,9 @@ setup(
     entry_points='''
         [ckan.plugins]
         ands=ckanext.ands.plugin:AndsPlugin
+
+        [paste.paster_command]
+        ands=ckanext.ands.commands:AndsCommand
 	[babel.extractors]
 	ckan = ckan.lib.extract:extract_ckan
     ''',